@@ -0,0 +1,472 @@
+import argparse
+import functools
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from cache_util import percentile
+from format_jira_ticket import (REGEX_BACKENDS, _atlassian_to_markdown_regex,
+                                atlassian_to_markdown, compact_logs, format_comments_display,
+                                html_to_markdown, main)
+
+_WORDS = (
+    "guest user client portal authorization failed radius timeout reached ap "
+    "ssid venue tenant controller firmware upgrade reboot dhcp lease vlan "
+    "switch port captive session expired token refresh dashboard filter"
+).split()
+
+# Markup fragments mixed into synthetic bodies, roughly in the proportions
+# they show up in ER tickets.
+_MARKUP = (
+    lambda rng: f"h{rng.randint(1, 4)}. {_sentence(rng, 4)}",
+    lambda rng: f"+*{_sentence(rng, 2)}*+ {_sentence(rng, 6)}",
+    lambda rng: f"  > {_sentence(rng, 10)}",
+    lambda rng: f"!image-2025{rng.randint(0, 9999):04d}.png|width=800,height=369!",
+    lambda rng: "\\" + "-" * rng.randint(3, 40),
+    lambda rng: f"{_sentence(rng, 5)}\xa0\t\xa0{_sentence(rng, 5)}",
+    lambda rng: "\n\n\n",
+)
+
+# (name, comment count, bytes per comment body, description bytes, markup density[,
+# share of lines that start a {noformat} log block])
+SCENARIOS = (
+    ("comments-10", 10, 1024, 4096, 0.2),
+    ("comments-100", 100, 1024, 4096, 0.2),
+    ("comments-1000", 1000, 1024, 4096, 0.2),
+    ("comments-5000", 5000, 1024, 4096, 0.2),
+    ("body-1k", 5, 512, 1024, 0.2),
+    ("body-64k", 5, 512, 64 * 1024, 0.2),
+    ("body-1m", 5, 512, 1024 * 1024, 0.2),
+    ("body-5m", 5, 512, 5 * 1024 * 1024, 0.2),
+    ("density-0", 50, 2048, 256 * 1024, 0.0),
+    ("density-0.5", 50, 2048, 256 * 1024, 0.5),
+    ("density-1", 50, 2048, 256 * 1024, 1.0),
+    # Every line marked up: the most tokens per byte for the single-pass scanner
+    ("dense-2m", 5, 512, 2 * 1024 * 1024, 1.0),
+    ("logs-1m", 5, 4096, 1024 * 1024, 0.2, 0.05),
+)
+
+QUICK_SCENARIOS = ("comments-10", "comments-100", "body-1k", "body-64k", "density-0.5",
+                   "dense-2m")
+
+# (name, bytes of Confluence storage-format HTML) for --pages.
+PAGE_SCENARIOS = (
+    ("page-64k", 64 * 1024),
+    ("page-1m", 1024 * 1024),
+    ("page-5m", 5 * 1024 * 1024),
+)
+
+
+# Size of the smaller adversarial inputs; check_linear() also times them 16x
+# larger. The old regex chain is quadratic on several of them and would run
+# for hours at that size, so --reference checks it on inputs of at most
+# 16 * REFERENCE_SMALL characters.
+ADVERSARIAL_SMALL = 20_000
+REFERENCE_SMALL = 1_000
+
+# Inputs built to trigger backtracking or repeated look-ahead, keyed by name.
+# Each generator returns roughly n characters.
+ADVERSARIAL = {
+    "bang-no-bar": lambda n: "!" * n,
+    "bang-text-no-bar": lambda n: ("!" + "x" * 15) * (n // 16),
+    "bang-bar-no-close": lambda n: "!a|" + "b" * (n - 3),
+    "bangs-then-bar": lambda n: "!a" * (n // 2) + "|",
+    "bold-open-no-close": lambda n: "+*" * (n // 2),
+    "bold-open-text": lambda n: ("+*" + "x" * 14) * (n // 16),
+    "bold-close-next-line": lambda n: "+*a" * (n // 3) + "\n*+",
+    "bold-escaped-newline": lambda n: "+*a\\n" * (n // 5) + "*+",
+    "backslash-run": lambda n: "\\" * n,
+    "divider-run": lambda n: "\\" + "-" * (n - 1),
+    "space-before-quote": lambda n: "a" + " " * (n - 2) + ">",
+    "newlines-before-quote": lambda n: "a" + "\n \t" * (n // 3) + ">",
+    "nbsp-tab-run": lambda n: "\xa0\t" * (n // 2),
+    "headings": lambda n: "h1.\n" * (n // 4),
+    "escaped-newlines": lambda n: "\\n" * (n // 2),
+    "crlf-mix": lambda n: "\r\r\n" * (n // 3),
+    "pipes-and-bangs": lambda n: "|!" * (n // 2),
+    "code-tags-no-close": lambda n: "{code:x}" * (n // 8),
+    "code-tags-unterminated": lambda n: "{code:" * (n // 6),
+    "code-blocks": lambda n: "{noformat}a{noformat}" * (n // 21),
+    # Log lines, for the compact_logs target: one long line of digits that
+    # is not a hex word, and a long run of lines of the same shape
+    "log-digit-run": lambda n: "ERROR " + "1" * (n - 7) + "g",
+    "log-similar-lines": lambda n: "ERROR a1b2c3d4e5 retry\n" * (n // 23),
+}
+
+# Characters mixed by the random part of the corpus.
+_FUZZ_ALPHABET = list("ab +*!|>\\-h1.\n\r\t\xa0") + ["\\n", "+*", "*+", "h2. ", "!x|"]
+
+
+def fuzz_input(n: int, seed: int) -> str:
+    """Random markup-heavy text of about n characters."""
+    rng = random.Random(seed)
+    return "".join(rng.choice(_FUZZ_ALPHABET) for _ in range(n // 2))
+
+
+def _best_time(func, text: str, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def check_linear(func, small: int = ADVERSARIAL_SMALL, factor: int = 16, slack: float = 4.0,
+                 fuzz_seeds: int = 5) -> list:
+    """
+    Time func on every adversarial input at size small and small * factor.
+
+    Linear code should slow down by about factor; anything above
+    factor * slack is reported as superlinear. Returns one record per input.
+    """
+    corpus = dict(ADVERSARIAL)
+    for seed in range(fuzz_seeds):
+        corpus[f"fuzz-{seed}"] = lambda n, seed=seed: fuzz_input(n, seed)
+    records = []
+    for name, build in corpus.items():
+        t_small = max(_best_time(func, build(small)), 1e-6)
+        t_large = _best_time(func, build(small * factor))
+        growth = t_large / t_small
+        records.append({
+            "input": name,
+            "small_s": t_small,
+            "large_s": t_large,
+            "growth": growth,
+            "superlinear": growth > factor * slack,
+        })
+    return records
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+# Lines of the synthetic logs and stack traces wrapped in {noformat} blocks.
+_LOG_LINES = (
+    lambda rng: (f"2025-06-{rng.randint(1, 30):02d} {rng.randint(0, 23):02d}:00:00 ERROR "
+                 f"[pid={rng.randint(100, 9999)}] {_sentence(rng, 6)} | rc={rng.randint(-5, 5)}"),
+    lambda rng: f"\tat com.ruckus.{rng.choice(_WORDS)}.Handler.run(Handler.java:{rng.randint(1, 999)})",
+    lambda rng: f"  +-- {rng.choice(_WORDS)}!{rng.randint(0, 99)}  ->  {rng.choice(_WORDS)}\\state",
+)
+
+
+def _log_block(rng: random.Random) -> str:
+    lines = [rng.choice(_LOG_LINES)(rng) for _ in range(rng.randint(20, 200))]
+    return "{noformat}\n" + "\n".join(lines) + "\n{noformat}"
+
+
+def make_body(rng: random.Random, size: int, density: float, logs: float = 0.0) -> str:
+    """
+    Build roughly size characters of wiki markup; density is the share of markup
+    lines and logs the share of lines that start a {noformat} log block.
+    """
+    lines = []
+    total = 0
+    while total < size:
+        if logs and rng.random() < logs:
+            line = _log_block(rng)
+        elif rng.random() < density:
+            line = rng.choice(_MARKUP)(rng)
+        else:
+            line = _sentence(rng, rng.randint(3, 20))
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines)[:size]
+
+
+def make_issue(key: str, comments: int, comment_bytes: int, description_bytes: int,
+               density: float, logs: float = 0.0, seed: int = 0) -> dict:
+    """Synthetic issue in the get_issue payload shape main() reads."""
+    rng = random.Random(seed)
+    return {
+        "key": key,
+        "fields": {
+            "summary": _sentence(rng, 12),
+            "description": make_body(rng, description_bytes, density, logs),
+            "customfield_10205": make_body(rng, 2048, density),
+            "comment": {
+                "comments": [
+                    {
+                        "id": str(10000 + i),
+                        "author": {"displayName": f"User {i % 17}"},
+                        "body": make_body(rng, comment_bytes, density, logs),
+                    }
+                    for i in range(comments)
+                ],
+                "maxResults": comments,
+                "startAt": 0,
+                "total": comments,
+            },
+        },
+    }
+
+
+# Blocks of the synthetic pages, roughly in the mix of our wiki test plans.
+_PAGE_BLOCKS = (
+    lambda rng: "<h{0}>{1}</h{0}>".format(rng.randint(1, 3), _sentence(rng, 4)),
+    lambda rng: (f"<p>{_sentence(rng, 12)} <strong>{_sentence(rng, 2)}</strong> "
+                 f"<a href=\"https://wiki.example.com/{rng.choice(_WORDS)}\">"
+                 f"{_sentence(rng, 3)}</a> {_sentence(rng, 8)}</p>"),
+    lambda rng: "<ul>" + "".join(f"<li>{_sentence(rng, 6)}</li>"
+                                 for _ in range(rng.randint(2, 8))) + "</ul>",
+    lambda rng: ("<table><tbody><tr><th>Step</th><th>Expected</th></tr>"
+                 + "".join(f"<tr><td><p>{_sentence(rng, 5)}</p></td><td>{_sentence(rng, 7)}</td></tr>"
+                           for _ in range(rng.randint(2, 10))) + "</tbody></table>"),
+    lambda rng: "<pre>" + "\n".join(rng.choice(_LOG_LINES)(rng).replace("<", "&lt;")
+                                    for _ in range(rng.randint(3, 20))) + "</pre>",
+    # Storage-format macros, links and images
+    lambda rng: ('<ac:structured-macro ac:name="code" ac:schema-version="1">'
+                 '<ac:parameter ac:name="language">java</ac:parameter><ac:plain-text-body>'
+                 "<![CDATA[" + "\n".join(rng.choice(_LOG_LINES)(rng)
+                                          for _ in range(rng.randint(3, 20)))
+                 + "]]></ac:plain-text-body></ac:structured-macro>"),
+    lambda rng: ('<ac:structured-macro ac:name="{}" ac:schema-version="1"><ac:rich-text-body>'
+                 "<p>{}</p></ac:rich-text-body></ac:structured-macro>").format(
+                     rng.choice(("info", "note", "warning", "tip")), _sentence(rng, 15)),
+    lambda rng: ('<p><ac:structured-macro ac:name="toc" ac:schema-version="1">'
+                 '<ac:parameter ac:name="maxLevel">3</ac:parameter></ac:structured-macro></p>'),
+    lambda rng: (f'<p>{_sentence(rng, 6)} <ac:link><ri:page ri:content-title="{_sentence(rng, 2)}" />'
+                 f'</ac:link> <ac:image ac:alt="{rng.choice(_WORDS)}"><ri:attachment '
+                 f'ri:filename="image-{rng.randint(0, 9999)}.png" /></ac:image></p>'),
+)
+
+
+def make_page(rng: random.Random, size: int) -> str:
+    """Build roughly size characters of Confluence storage format (body.storage)."""
+    blocks = []
+    total = 0
+    while total < size:
+        block = rng.choice(_PAGE_BLOCKS)(rng)
+        blocks.append(block)
+        total += len(block)
+    return "".join(blocks)
+
+
+def _issue_bytes(issue: dict) -> int:
+    fields = issue["fields"]
+    texts = [fields["description"], fields["customfield_10205"]]
+    texts += [c["body"] for c in fields["comment"]["comments"]]
+    return sum(len(t.encode("utf-8")) for t in texts)
+
+
+def measure(func, arg, input_bytes: int, budget: float = 1.0, max_repeat: int = 50) -> dict:
+    """Time func(arg) repeatedly within a time budget, then once more for peak memory."""
+    latencies = []
+    deadline = time.perf_counter() + budget
+    while len(latencies) < max_repeat and (len(latencies) < 3 or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        func(arg)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mean = statistics.fmean(latencies)
+    return {
+        "runs": len(latencies),
+        "mean_s": mean,
+        "p50_s": percentile(latencies, 50),
+        "p90_s": percentile(latencies, 90),
+        "p99_s": percentile(latencies, 99),
+        "calls_per_s": 1 / mean if mean else 0.0,
+        "mb_per_s": input_bytes / mean / 1e6 if mean else 0.0,
+        "peak_bytes": peak,
+    }
+
+
+def run_scenario(name: str, comments: int, comment_bytes: int, description_bytes: int,
+                 density: float, logs: float = 0.0, budget: float = 1.0,
+                 backends: tuple = (), reference: bool = False) -> dict:
+    """
+    Measure the conversion entry points on one synthetic issue. Each name in
+    backends adds an atlassian_to_markdown[<backend>] entry timing the
+    description on that regex backend, after checking it converts the same.
+    With reference, a reference entry times the old regex chain on it too.
+    """
+    issue = make_issue(f"BENCH-{name}", comments, comment_bytes, description_bytes,
+                       density, logs)
+    fields = issue["fields"]
+    comment_list = fields["comment"]["comments"]
+    description_bytes = len(fields["description"].encode("utf-8"))
+    expected = atlassian_to_markdown(fields["description"])
+    per_backend = {}
+    for backend in backends:
+        convert = functools.partial(atlassian_to_markdown, backend=backend)
+        if convert(fields["description"]) != expected:
+            raise AssertionError(f"{name}: backend {backend!r} output differs")
+        per_backend[f"atlassian_to_markdown[{backend}]"] = measure(
+            convert, fields["description"], description_bytes, budget)
+    if reference:
+        per_backend["reference"] = measure(
+            _atlassian_to_markdown_regex, fields["description"], description_bytes, budget)
+    return {
+        "scenario": name,
+        "comments": comments,
+        "comment_bytes": comment_bytes,
+        "description_bytes": description_bytes,
+        "density": density,
+        "logs": logs,
+        "input_bytes": _issue_bytes(issue),
+        "atlassian_to_markdown": measure(
+            atlassian_to_markdown, fields["description"], description_bytes, budget),
+        "format_comments_display": measure(
+            format_comments_display, comment_list,
+            sum(len(c["body"].encode("utf-8")) for c in comment_list), budget),
+        "main": measure(main, [{"issue": issue}], _issue_bytes(issue), budget),
+        **per_backend,
+    }
+
+
+def run_page(name: str, size: int, budget: float = 1.0) -> dict:
+    """
+    Measure html_to_markdown() on one synthetic page, and html2text (what the
+    Confluence workflows used before) on the same page if it is installed.
+    """
+    page = make_page(random.Random(0), size)
+    page_bytes = len(page.encode("utf-8"))
+    result = {
+        "scenario": name,
+        "input_bytes": page_bytes,
+        "html_to_markdown": measure(html_to_markdown, page, page_bytes, budget),
+    }
+    try:
+        import html2text
+    except ImportError:
+        return result
+
+    def reference(html_data):
+        converter = html2text.HTML2Text()
+        converter.ignore_links = False
+        return converter.handle(html_data)
+
+    result["html2text"] = measure(reference, page, page_bytes, budget, max_repeat=5)
+    return result
+
+
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    """Return regressions where mean latency grew by more than tolerance (e.g. 0.2 = 20%)."""
+    previous = {r["scenario"]: r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result["scenario"])
+        if old is None:
+            continue
+        for target in ("atlassian_to_markdown", "format_comments_display", "main"):
+            before = old[target]["mean_s"]
+            after = result[target]["mean_s"]
+            if before and after > before * (1 + tolerance):
+                regressions.append(f"{result['scenario']}/{target}: "
+                                   f"{before * 1e3:.2f} ms -> {after * 1e3:.2f} ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Jira-to-Markdown path.")
+    parser.add_argument("--quick", action="store_true", help="run a small subset of scenarios")
+    parser.add_argument("--scenario", action="append", default=[],
+                        help="run only the named scenario (repeatable)")
+    parser.add_argument("--budget", type=float, default=1.0,
+                        help="seconds of timing per target and scenario")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="earlier JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against the baseline before failing")
+    parser.add_argument("--adversarial", action="store_true",
+                        help="check that conversion and log compaction time grow linearly "
+                             "on the adversarial corpus and exit 1 if they do not")
+    parser.add_argument("--reference", action="store_true",
+                        help="also time the old regex chain on each description; with "
+                             "--adversarial, check it instead, on inputs capped at "
+                             f"{16 * REFERENCE_SMALL} characters")
+    parser.add_argument("--backend", action="append", default=[], choices=REGEX_BACKENDS,
+                        help="also time atlassian_to_markdown on this regex backend "
+                             "(repeatable); with --adversarial, check these backends")
+    parser.add_argument("--pages", action="store_true",
+                        help="time html_to_markdown against html2text on large Confluence "
+                             "pages instead of the Jira scenarios")
+    args = parser.parse_args()
+
+    if args.pages:
+        results = []
+        for name, size in PAGE_SCENARIOS:
+            result = run_page(name, size, budget=args.budget)
+            results.append(result)
+            for target in ("html_to_markdown", "html2text"):
+                if target in result:
+                    timing = result[target]
+                    print(f"{name:>9}  {result['input_bytes'] / 1e6:6.2f} MB  {target:<16} "
+                          f"p50 {timing['p50_s'] * 1e3:9.2f} ms  {timing['mb_per_s']:6.2f} MB/s  "
+                          f"peak {timing['peak_bytes'] / 1e6:7.2f} MB", file=sys.stderr)
+        print(json.dumps({"pages": results}, indent=2))
+        sys.exit(0)
+
+    if args.adversarial:
+        small = ADVERSARIAL_SMALL
+        if args.reference:
+            targets = {"reference": _atlassian_to_markdown_regex}
+            small = REFERENCE_SMALL
+        else:
+            targets = {backend: functools.partial(atlassian_to_markdown, backend=backend)
+                       for backend in args.backend or [None]}
+            targets["compact_logs"] = compact_logs
+        report = {}
+        for target, func in targets.items():
+            records = report[target or "default"] = check_linear(func, small)
+            for record in records:
+                print(f"{target or 'default':>12} {record['input']:>22}  "
+                      f"{record['small_s'] * 1e3:9.2f} ms  "
+                      f"{record['large_s'] * 1e3:9.2f} ms  x{record['growth']:7.1f}"
+                      f"{'  SUPERLINEAR' if record['superlinear'] else ''}", file=sys.stderr)
+        print(json.dumps({"adversarial": report}, indent=2))
+        sys.exit(1 if any(r["superlinear"] for rs in report.values() for r in rs) else 0)
+
+    selected = set(args.scenario) or (set(QUICK_SCENARIOS) if args.quick else None)
+    results = []
+    for scenario in SCENARIOS:
+        if selected is not None and scenario[0] not in selected:
+            continue
+        result = run_scenario(*scenario, budget=args.budget, backends=tuple(args.backend),
+                              reference=args.reference)
+        results.append(result)
+        print(f"{result['scenario']:>14}  "
+              f"{result['input_bytes'] / 1e6:8.2f} MB  "
+              f"main p50 {result['main']['p50_s'] * 1e3:9.2f} ms  "
+              f"{result['main']['calls_per_s']:9.2f} issues/s  "
+              f"{result['main']['mb_per_s']:7.2f} MB/s  "
+              f"peak {result['main']['peak_bytes'] / 1e6:7.2f} MB", file=sys.stderr)
+        for backend in args.backend:
+            timing = result[f"atlassian_to_markdown[{backend}]"]
+            print(f"{'':>14}  description on {backend:<4} p50 {timing['p50_s'] * 1e3:9.2f} ms  "
+                  f"{timing['mb_per_s']:7.2f} MB/s", file=sys.stderr)
+        if args.reference:
+            for target in ("atlassian_to_markdown", "reference"):
+                timing = result[target]
+                print(f"{'':>14}  description {target:<21} p50 {timing['p50_s'] * 1e3:9.2f} ms  "
+                      f"{timing['mb_per_s']:7.2f} MB/s", file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for line in regressions:
+            print(f"regression: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
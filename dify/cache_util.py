@@ -0,0 +1,46 @@
+import contextlib
+
+
+def percentile(samples, pct: float) -> float:
+    """The sample at rank pct (0-100) of samples, by nearest rank."""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+@contextlib.contextmanager
+def immediate(db):
+    """
+    Run the block in a transaction that takes SQLite's write lock up front,
+    committing on success and rolling back on any exception.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+
+def trim_lru(db, table: str, key: str, max_bytes: int) -> int:
+    """
+    Evict the least recently used rows of table until their sizes add up to
+    at most max_bytes, and return what is left.
+
+    The table needs size and last_used columns; rows are deleted by their
+    key column. Call it inside immediate(): several processes may share the
+    file, so the total is summed from the table under the write lock rather
+    than tracked per process.
+    """
+    total = db.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+    if total <= max_bytes:
+        return total
+    victims = []
+    for old_key, old_size in db.execute(f"SELECT {key}, size FROM {table} ORDER BY last_used"):
+        victims.append((old_key,))
+        total -= old_size
+        if total <= max_bytes:
+            break
+    db.executemany(f"DELETE FROM {table} WHERE {key} = ?", victims)
+    return total
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from cache_util import immediate, percentile, trim_lru
+from format_jira_ticket import html_to_markdown
+from jira_fetch import JiraSession
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    page_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    namespace TEXT NOT NULL,
+    title TEXT NOT NULL,
+    markdown TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+# Latency samples kept per lookup outcome for the percentiles in stats().
+_SAMPLES = 4096
+
+_OUTCOMES = ("hit", "stale", "miss")
+
+
+class PageCache:
+    """
+    Converted Confluence pages on disk, keyed by page id and version number.
+
+    Each page is kept once, at the version it was converted from, together
+    with the converter namespace (so a changed converter starts over); a
+    newer version replaces it. Rows live in a SQLite file trimmed back to
+    max_bytes of Markdown by evicting the least recently used pages.
+    Lookups are counted as hits, stale (the page is cached at another
+    version) or misses, and the latency of each outcome, measured by
+    fetch_page() from the version check to the Markdown, is sampled for
+    stats().
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024,
+                 convert=html_to_markdown, namespace: str = "html_to_markdown/2"):
+        self.max_bytes = max_bytes
+        self.convert = convert
+        self.namespace = namespace
+        self.counts = dict.fromkeys(_OUTCOMES, 0)
+        self.latencies = {outcome: collections.deque(maxlen=_SAMPLES) for outcome in _OUTCOMES}
+        self.seconds = dict.fromkeys(_OUTCOMES, 0.0)
+        self.db = sqlite3.connect(os.fspath(path), timeout=30)
+        self.db.execute(_SCHEMA)
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_lru ON pages (last_used)")
+        self.bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        self.db.commit()
+
+    def lookup(self, page_id: str, version: int) -> tuple:
+        """(outcome, (title, markdown) or None) for the page at this version."""
+        row = self.db.execute("SELECT version, namespace, title, markdown FROM pages "
+                              "WHERE page_id = ?", (page_id,)).fetchone()
+        if row is None:
+            outcome, entry = "miss", None
+        elif row[0] != version or row[1] != self.namespace:
+            outcome, entry = "stale", None
+        else:
+            self.db.execute("UPDATE pages SET last_used = ? WHERE page_id = ?",
+                            (time.time(), page_id))
+            self.db.commit()
+            outcome, entry = "hit", (row[2], row[3])
+        self.counts[outcome] += 1
+        return outcome, entry
+
+    def put(self, page_id: str, version: int, title: str, markdown: str) -> None:
+        size = len(markdown.encode("utf-8", "surrogatepass"))
+        with immediate(self.db):
+            self.db.execute("DELETE FROM pages WHERE page_id = ?", (page_id,))
+            if size <= self.max_bytes:
+                self.db.execute("INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (page_id, version, self.namespace, title, markdown, size,
+                                 time.time()))
+            self.bytes = trim_lru(self.db, "pages", "page_id", self.max_bytes)
+
+    def observe(self, outcome: str, seconds: float) -> None:
+        """Record the latency of one lookup ending in outcome ("hit", "stale" or "miss")."""
+        self.latencies[outcome].append(seconds)
+        self.seconds[outcome] += seconds
+
+    def stats(self) -> dict:
+        """Lookup counters, store size and latency per outcome."""
+        lookups = sum(self.counts.values())
+        latency = {}
+        for outcome, samples in self.latencies.items():
+            if samples:
+                latency[outcome] = {
+                    "count": len(samples),
+                    "mean_s": statistics.fmean(samples),
+                    "p50_s": percentile(samples, 50),
+                    "p99_s": percentile(samples, 99),
+                    "seconds_total": self.seconds[outcome],
+                }
+        return {
+            **self.counts,
+            "hit_ratio": self.counts["hit"] / lookups if lookups else 0.0,
+            "pages": self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0],
+            "bytes": self.bytes,
+            "latency": latency,
+        }
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def format_page(title: str, markdown: str) -> str:
+    """The text the Confluence2Md workflow returns for a page."""
+    return f"\n* {title}\n\n{markdown}\n"
+
+
+async def fetch_page(session: JiraSession, cache: PageCache, page_id: str,
+                     api: str = "/wiki/rest/api") -> dict:
+    """
+    Markdown of one page, converted only if the cache lacks its current version.
+
+    The version check asks for the page without its body, which is a few
+    hundred bytes however large the page is; the body is fetched and
+    converted only on a miss.
+    """
+    started = time.perf_counter()
+    path = f"{api}/content/{page_id}"
+    meta = await session.get_json(path, {"expand": "version"})
+    version = meta["version"]["number"]
+    outcome, cached = cache.lookup(page_id, version)
+    if cached is not None:
+        title, markdown = cached
+    else:
+        page = await session.get_json(path, {"expand": "body.storage,version"})
+        version = page["version"]["number"]
+        title = page["title"]
+        markdown = cache.convert(page["body"]["storage"]["value"])
+        cache.put(page_id, version, title, markdown)
+    cache.observe(outcome, time.perf_counter() - started)
+    return {"id": page_id, "version": version, "title": title, "markdown": markdown,
+            "cached": outcome == "hit"}
+
+
+def fetch_pages(page_ids: list, base_url: str, cache: PageCache, auth=None,
+                concurrency: int = 8, api: str = "/wiki/rest/api") -> list:
+    """
+    Fetch pages through the cache over one pooled session; {"id", "result"} /
+    {"id", "error"} records come back in the order of page_ids, with result
+    in the shape the Confluence2Md workflow returns.
+    """
+    async def one(session, page_id):
+        try:
+            page = await fetch_page(session, cache, page_id, api)
+        except Exception as exc:
+            return {"id": page_id, "error": f"{type(exc).__name__}: {exc}"}
+        return {"id": page_id, "version": page["version"], "cached": page["cached"],
+                "result": format_page(page["title"], page["markdown"])}
+
+    async def run():
+        async with JiraSession(base_url, auth, limit=concurrency) as session:
+            return await asyncio.gather(*(one(session, page_id) for page_id in page_ids))
+
+    return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fetch Confluence pages as Markdown through a version-keyed cache.")
+    parser.add_argument("pages", nargs="*", help="page ids")
+    parser.add_argument("--cache", default=os.environ.get("CONFLUENCE_PAGE_CACHE",
+                                                          "confluence_pages.sqlite"),
+                        help="SQLite file of converted pages (default: $CONFLUENCE_PAGE_CACHE "
+                             "or confluence_pages.sqlite)")
+    parser.add_argument("--max-bytes", type=int, default=256 * 1024 * 1024,
+                        help="Markdown kept in the cache before the least recently used "
+                             "pages are evicted")
+    parser.add_argument("--base-url", default=os.environ.get("CONFLUENCE_BASE_URL"),
+                        help="Confluence site (default: $CONFLUENCE_BASE_URL)")
+    parser.add_argument("--api", default="/wiki/rest/api",
+                        help="REST API path below the site; /rest/api on Server/Data Center")
+    parser.add_argument("--user", default=os.environ.get("JIRA_USER"),
+                        help="account for basic auth (default: $JIRA_USER)")
+    parser.add_argument("--token", default=os.environ.get("JIRA_API_TOKEN"),
+                        help="API token (default: $JIRA_API_TOKEN); a bearer token without --user")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="requests in flight and pooled connections")
+    parser.add_argument("--mock", type=int, metavar="N",
+                        help="serve N synthetic pages from a local mock, fetch them cold, warm "
+                             "and after editing a few, and check the output against "
+                             "converting them directly")
+    parser.add_argument("--mock-page-bytes", type=int, default=1024 * 1024,
+                        help="with --mock, size of each page")
+    args = parser.parse_args()
+
+    if args.mock:
+        from jira_mock import MockJira
+
+        with tempfile.TemporaryDirectory() as scratch, MockJira(
+                count=0, page_count=args.mock, page_bytes=args.mock_page_bytes) as wiki:
+            cache = PageCache(os.path.join(scratch, "pages.sqlite"), args.max_bytes)
+            ids = list(wiki.pages)
+            for run in ("cold", "warm", "edited"):
+                if run == "edited":
+                    for page_id in ids[::4]:
+                        page = wiki.pages[page_id]
+                        page["version"]["number"] += 1
+                        page["body"]["storage"]["value"] += "<p>Edited.</p>"
+                requests = wiki.requests
+                started = time.perf_counter()
+                records = fetch_pages(ids, wiki.url, cache, concurrency=args.concurrency)
+                elapsed = time.perf_counter() - started
+                for record in records:
+                    page = wiki.pages[record["id"]]
+                    expected = format_page(page["title"],
+                                           html_to_markdown(page["body"]["storage"]["value"]))
+                    if record.get("result") != expected:
+                        sys.exit(f"{record['id']}: {run} output differs: {record.get('error')}")
+                cached = sum(record["cached"] for record in records)
+                print(f"{run:>6}: {len(ids)} pages in {elapsed:.3f} s, {cached} from the cache, "
+                      f"{wiki.requests - requests} requests", file=sys.stderr)
+            print(json.dumps(cache.stats(), indent=2))
+            cache.close()
+        sys.exit(0)
+
+    if not args.base_url or not args.pages:
+        parser.error("page ids and --base-url (or $CONFLUENCE_BASE_URL) are required")
+    auth = (args.user, args.token) if args.user else args.token
+    cache = PageCache(args.cache, args.max_bytes)
+    failures = 0
+    for record in fetch_pages(args.pages, args.base_url, cache, auth, args.concurrency, args.api):
+        failures += "error" in record
+        print(json.dumps(record, ensure_ascii=False))
+    print(json.dumps(cache.stats()), file=sys.stderr)
+    cache.close()
+    if failures:
+        print(f"{failures} page(s) failed", file=sys.stderr)
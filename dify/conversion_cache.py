@@ -0,0 +1,181 @@
+import hashlib
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from cache_util import immediate, trim_lru
+from format_jira_ticket import atlassian_to_markdown
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    key BLOB PRIMARY KEY,
+    markdown TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+# Disk hits whose last_used update is held back and written in one batch.
+_TOUCH_BATCH = 256
+
+
+class ConversionCache:
+    """
+    Content-addressed cache in front of a markup converter.
+
+    Conversions are keyed by a hash of the raw text (and the cache namespace,
+    so a changed converter can be given a fresh one). Lookups go through a
+    bounded in-memory LRU tier first, then an optional SQLite file that is
+    trimmed back to max_disk_bytes by evicting the least recently used rows.
+    The file may be shared by several processes. Disk hits refresh their
+    row's last_used in batches (with the next store, every _TOUCH_BATCH hits
+    and on close()), so recency on disk can lag by that much. Instances are
+    callables, so they can be passed wherever atlassian_to_markdown is
+    expected.
+    """
+
+    def __init__(self, max_entries: int = 1024, path: str = None,
+                 max_disk_bytes: int = 64 * 1024 * 1024,
+                 convert=atlassian_to_markdown, namespace: str = "atlassian_to_markdown/2"):
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.convert = convert
+        self.namespace = namespace.encode("utf-8") + b"\0"
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        self.disk_bytes = 0
+        self.touched = {}
+        if path is not None:
+            self.db = sqlite3.connect(os.fspath(path), timeout=30)
+            self.db.execute(_SCHEMA)
+            self.db.execute("CREATE INDEX IF NOT EXISTS conversions_lru ON conversions (last_used)")
+            self.disk_bytes = self.db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM conversions").fetchone()[0]
+            self.db.commit()
+
+    def _key(self, text: str) -> bytes:
+        digest = hashlib.blake2b(self.namespace, digest_size=16)
+        digest.update(text.encode("utf-8", "surrogatepass"))
+        return digest.digest()
+
+    def _remember(self, key: bytes, markdown: str) -> None:
+        self.memory[key] = markdown
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _flush_touched(self) -> None:
+        """Write the held-back last_used updates of disk hits."""
+        self.db.executemany("UPDATE conversions SET last_used = ? WHERE key = ?",
+                            [(used, key) for key, used in self.touched.items()])
+        self.touched.clear()
+
+    def _store(self, key: bytes, markdown: str) -> None:
+        size = len(markdown.encode("utf-8", "surrogatepass"))
+        if size > self.max_disk_bytes:
+            return
+        with immediate(self.db):
+            self._flush_touched()
+            self.db.execute("INSERT OR IGNORE INTO conversions VALUES (?, ?, ?, ?)",
+                            (key, markdown, size, time.time()))
+            self.disk_bytes = trim_lru(self.db, "conversions", "key", self.max_disk_bytes)
+
+    def __call__(self, text: str) -> str:
+        if not isinstance(text, str):
+            # ADF trees (REST API v3) render in one walk without regexes
+            return self.convert(text)
+        key = self._key(text)
+        markdown = self.memory.get(key)
+        if markdown is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return markdown
+        if self.db is not None:
+            row = self.db.execute("SELECT markdown FROM conversions WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is not None:
+                self.touched[key] = time.time()
+                if len(self.touched) >= _TOUCH_BATCH:
+                    self._flush_touched()
+                    self.db.commit()
+                self.disk_hits += 1
+                self._remember(key, row[0])
+                return row[0]
+        self.misses += 1
+        markdown = self.convert(text)
+        self._remember(key, markdown)
+        if self.db is not None:
+            self._store(key, markdown)
+        return markdown
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current tier sizes."""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_bytes": self.disk_bytes,
+        }
+
+    def close(self) -> None:
+        if self.db is not None:
+            if self.touched:
+                self._flush_touched()
+                self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    calls = []
+
+    def convert(text):
+        calls.append(text)
+        return atlassian_to_markdown(text)
+
+    # The memory tier answers repeats and keeps only the newest max_entries
+    cache = ConversionCache(max_entries=2, convert=convert)
+    for text in ("h1. a", "h1. a", "*b*", "h2. c", "h1. a"):
+        cache(text)
+    assert calls == ["h1. a", "*b*", "h2. c", "h1. a"]
+    assert cache.stats()["hits"] == 1 and cache.stats()["memory_entries"] == 2
+
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, "conversions.sqlite")
+        texts = [f"h2. Section {i}\n" + "x" * 1000 for i in range(20)]
+
+        # The SQLite tier is trimmed to max_disk_bytes, oldest rows first
+        cache = ConversionCache(max_entries=1, path=path, max_disk_bytes=8000, convert=convert)
+        for text in texts:
+            cache(text)
+        cache.close()
+        reopened = ConversionCache(path=path)
+        assert 7000 < reopened.disk_bytes <= 8000
+        reopened.close()
+
+        # A new process finds the newest conversions on disk, and the touches
+        # of its disk hits reach the file on close()
+        calls.clear()
+        cache = ConversionCache(max_entries=1, path=path, max_disk_bytes=8000, convert=convert)
+        started = time.time()
+        assert [cache(text) for text in texts[-3:]] == [atlassian_to_markdown(t) for t in texts[-3:]]
+        assert calls == [] and cache.stats()["disk_hits"] == 3
+        cache.close()
+        db = sqlite3.connect(path)
+        assert db.execute("SELECT COUNT(*) FROM conversions WHERE last_used >= ?",
+                          (started,)).fetchone()[0] == 3
+        db.close()
+
+        # Bumping the namespace makes every earlier conversion a miss
+        cache = ConversionCache(path=path, convert=convert, namespace="atlassian_to_markdown/3")
+        cache(texts[-1])
+        assert calls == [texts[-1]] and cache.stats()["disk_hits"] == 0
+        cache.close()
@@ -1,9 +1,1931 @@
+import collections
+import datetime
+import functools
+import hashlib
+import html.parser
+import itertools
+import json
+import os
 import re
+import time
+import warnings
+from typing import Optional
 
 
-def atlassian_to_markdown(text: str) -> str:
+class StageProfile:
+    """
+    Per-stage wall time, call counts and bytes in/out for the conversion path.
+
+    Stages are the public entry points (atlassian_to_markdown,
+    format_comments_display, format_issue, main) plus one "scan.<token>" stage
+    per token kind inside the single-pass converter.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage: str, seconds: float, bytes_in: int = 0, bytes_out: int = 0) -> None:
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = {"calls": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0}
+        entry["calls"] += 1
+        entry["seconds"] += seconds
+        entry["bytes_in"] += bytes_in
+        entry["bytes_out"] += bytes_out
+
+    def as_dict(self) -> dict:
+        return {stage: dict(entry) for stage, entry in self.stages.items()}
+
+    def to_prometheus(self, prefix: str = "jira_markdown") -> str:
+        """Render the counters in the Prometheus text exposition format."""
+        lines = []
+        for metric, field in (("stage_seconds_total", "seconds"), ("stage_calls_total", "calls"),
+                              ("stage_bytes_in_total", "bytes_in"),
+                              ("stage_bytes_out_total", "bytes_out")):
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            for stage, entry in sorted(self.stages.items()):
+                lines.append(f'{prefix}_{metric}{{stage="{stage}"}} {entry[field]}')
+        return "\n".join(lines) + "\n"
+
+
+# Active profile, or None. Checked once per call (and once per token inside
+# the converter), so disabled profiling costs a global lookup.
+_profile = None
+
+
+def enable_profiling() -> StageProfile:
+    """Start recording stage metrics into a fresh StageProfile and return it."""
+    global _profile
+    _profile = StageProfile()
+    return _profile
+
+
+def disable_profiling() -> StageProfile:
+    """Stop recording and return the profile collected so far (or None)."""
+    global _profile
+    profile, _profile = _profile, None
+    return profile
+
+
+def _size(value) -> int:
+    """
+    Characters of markup in a profiled call's argument or result: strings as
+    they are, ADF trees serialized, the result of a workflow, and the markup
+    fields (description, root cause, comment bodies) of issues, Jira
+    responses and comment lists.
+    """
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, list):
+        return sum(_size(item) for item in value)
+    if not isinstance(value, dict):
+        return 0
+    if isinstance(value.get("result"), str):
+        return len(value["result"])
+    if "body" in value:
+        return _size(value["body"])
+    if "issue" in value:
+        return _size(value["issue"])
+    fields = value.get("fields")
+    if isinstance(fields, dict):
+        comments = (fields.get("comment") or {}).get("comments") or []
+        return (_size(fields.get("description")) + _size(fields.get("customfield_10205"))
+                + _size(comments))
+    if "type" in value:
+        # An ADF node; sized as the JSON Jira sends
+        return len(json.dumps(value, ensure_ascii=False))
+    return 0
+
+
+def _profiled(stage: str):
+    """Record wall time and str sizes of the wrapped call while profiling is enabled."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _profile
+            if profile is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            profile.record(stage, time.perf_counter() - started,
+                           _size(args[0]) if args else 0, _size(result))
+            return result
+        return wrapper
+    return decorate
+
+
+# Regex engines the converter can run on. "re2" (google-re2) guarantees
+# linear-time matching but supports neither lookaround nor Unicode \s, so
+# the token grammar below is written without them. Only the patterns built
+# by compile_rules() run on the chosen engine; the other module-level
+# patterns always use re. _TOKEN_PIECE needs a backreference and
+# _SENTENCE_END a lookahead, which re2 lacks. _HTML_SPACE, _HTML_LANGUAGE,
+# _DIGEST_MARKUP, _SENTENCE_END, _LOG_LINE, _STACK_FRAME, _LOG_VARIABLE,
+# _TOKEN_PIECE, _MD_HEADING, _MD_FENCE and _BACKTICK_RUN were timed on
+# inputs built against their quantifiers (runs of unclosed brackets, digits,
+# spaces and repeated punctuation) and grew linearly; bench_format_jira.py
+# --adversarial keeps checking the log patterns through compact_logs().
+REGEX_BACKENDS = ("re", "re2")
+
+
+def regex_backend(name: str = None):
+    """
+    Import the regex module called name, or the one named by the
+    JIRA_MARKDOWN_REGEX_BACKEND environment variable (default "re").
+
+    An unknown or uninstalled engine named by the environment falls back to
+    re with a warning, so a bad setting cannot break importing this module;
+    one passed as name raises ValueError or ImportError.
+    """
+    from_env = name is None
+    if from_env:
+        name = os.environ.get("JIRA_MARKDOWN_REGEX_BACKEND", "re")
+    try:
+        if name == "re":
+            return re
+        if name == "re2":
+            import re2
+            return re2
+        raise ValueError(f"unknown regex backend {name!r}, expected one of {REGEX_BACKENDS}")
+    except (ImportError, ValueError) as exc:
+        if not from_env:
+            raise
+        warnings.warn(f"JIRA_MARKDOWN_REGEX_BACKEND: {exc}; falling back to re", RuntimeWarning)
+        return re
+
+
+# Every whitespace character except the plain space, i.e. what str.isspace()
+# and Python's \s accept. Written as literal characters so that engines
+# without \u escapes read the same class.
+_BREAKING_SPACE = '\t\n\x0b\x0c\r\x1c-\x1f\x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000'
+_WHITESPACE = ' ' + _BREAKING_SPACE
+# Breaking whitespace a text run may not contain: tabs and non-breaking
+# spaces between words stay in the run and are collapsed there.
+_RUN_BREAK = _BREAKING_SPACE.replace('\t', '').replace('\xa0', '')
+
+MarkupRule = collections.namedtuple("MarkupRule", "name pattern replace triggers")
+MarkupRule.__doc__ = """
+One entry of the Atlassian-to-Markdown rule table.
+
+pattern is matched at token boundaries and must start with one of the
+rule's triggers; plain text runs stop at every trigger character so the
+rule gets a chance to match. A pattern starting with "(?m:^)" is line
+anchored: its triggers are the characters it can start a line with, and
+text runs only stop at those where a line starts. Patterns see literal
+"\\n" sequences already turned into newlines, should avoid lookaround so
+that they also compile under the re2 backend, and must not reuse a group
+name of another rule. replace is a template for Match.expand() or a
+callable taking the match; numbered groups in either refer to the rule's
+own pattern. Spaces at the end of a replacement are dropped if the line
+ends there.
+
+A rule without a pattern is stateful: replace is then a handler called as
+replace(state, text, position) for every trigger character the scan meets,
+returning the text to write there or None to write nothing. state is the
+call's ScanState.
+"""
+
+
+class ScanState:
+    """
+    Mutable state of one conversion, shared by the stateful rules' handlers.
+
+    skip_until is read by the scanner: every token before it is dropped.
+    The other fields belong to the built-in bold and image handlers; a
+    handler of another rule may keep its own fields here too.
+    """
+
+    def __init__(self, end: int):
+        self.end = end
+        self.skip_until = 0
+        self.bold_close = -1    # position of the "+" closing the current bold span
+        self.bold_resume = 0    # first position where a new bold span may open
+        self.img_bar = -1       # position of the "|" that ends the current image URL
+        self.img_end = -1       # position of the "!" that ends the current image
+        # Next occurrence of each delimiter the bold and image rules look
+        # ahead for. Lookups only move forward, so the cached positions are
+        # reused until the scan passes them and every character is searched
+        # at most once per delimiter; this keeps the conversion linear.
+        self.next_close = -1
+        self.next_lf = -1
+        self.next_bar = -1
+        self.next_bang = -1
+
+
+def _find(text: str, sub: str, start: int) -> int:
+    """str.find() that reports "not found" as len(text), so cached positions only grow."""
+    found = text.find(sub, start)
+    return len(text) if found == -1 else found
+
+
+def _bold_mark(state: ScanState, text: str, start: int):
+    """Bold text: +*text*+ → **text**, by turning both "+" into "*"."""
+    piece = '+'
+    if start == state.bold_close:
+        piece = '*'
+        state.bold_close = -1
+    elif start >= state.bold_resume and text.startswith('*', start + 1):
+        if state.next_close < start + 3:
+            state.next_close = _find(text, '*+', start + 3)
+        if state.next_lf < start + 2:
+            state.next_lf = _find(text, '\n', start + 2)
+        # The span may not cross a line break
+        if state.next_close < state.next_lf:
+            piece = '*'
+            state.bold_close = state.next_close + 1
+            state.bold_resume = state.next_close + 2
+    # Bold spans are matched inside dropped image parameters too, as the
+    # reference converts them before images
+    return None if start < state.skip_until else piece
+
+
+def _image_mark(state: ScanState, text: str, start: int):
+    """Image conversion: !URL|params! → ![](URL)"""
+    if start < state.skip_until:
+        return None
+    if text[start] == '!':
+        if state.next_bar <= start:
+            state.next_bar = _find(text, '|', start + 1)
+        if state.next_bang <= start:
+            state.next_bang = _find(text, '!', start + 1)
+        if start + 1 < state.next_bar < state.next_bang < state.end:
+            state.img_bar = state.next_bar
+            state.img_end = state.next_bang
+            return '![]('
+        return '!'
+    if start == state.img_bar:
+        state.img_bar = -1
+        state.skip_until = state.img_end + 1
+        return ')'
+    return text[start]
+
+
+def _heading(m) -> str:
+    return '#' * int(m.group('level')) + ' '
+
+
+# The conversion rules. They are merged into a single alternation by
+# compile_rules(), so the whole table costs one pass over the input.
+MARKUP_RULES = (
+    # Headings: h1. → #, h2. → ##, etc.
+    MarkupRule("heading", rf'(?m:^)h(?P<level>[1-6])\.[{_WHITESPACE}]+', _heading, "h"),
+    # Bold text: +*text*+ → **text**
+    MarkupRule("bold", None, _bold_mark, "+"),
+    # Image conversion: !URL|params! → ![](URL)
+    MarkupRule("image", None, _image_mark, "!|"),
+    # Escaped dividers to markdown horizontal rules
+    MarkupRule("divider", r'\\-+', "---", "\\"),
+)
+
+# Macros whose body is copied verbatim as a fenced block instead of being
+# converted, e.g. {code:java}...{code} or {noformat}...{noformat}.
+PROTECTED_MACROS = ("code", "noformat")
+
+RuleSet = collections.namedtuple("RuleSet",
+                                 "token space tabs protected replacements handlers stages")
+
+# Pieces of a whitespace run: plain spaces, tab/NBSP runs, newlines, and any
+# other single whitespace character.
+_SPACE_PART = r'(?s)( +)|([\xa0\t]+)|(\r?\n)|(.)'
+
+# Tab/NBSP runs inside a text run, each collapsed to one space.
+_TAB_RUN = '[\xa0\t]+'
+
+_LINE_ANCHOR = "(?m:^)"
+
+# Numbered group references (\1, \g<1>) and other escapes in a pattern or a
+# replacement template.
+_GROUP_REFERENCE = re.compile(r'\\(?:g<(\d+)>|([1-9][0-9]?)|.)', re.DOTALL)
+
+
+def _renumber(template: str, offset: int, in_pattern: bool) -> str:
+    """Shift the numbered group references of a rule by its offset in the merged grammar."""
+    def shift(m):
+        number = m.group(1) or m.group(2)
+        if number is None:
+            return m.group()
+        number = int(number) + offset
+        if not in_pattern:
+            return rf'\g<{number}>'
+        if number > 99:
+            raise ValueError("numbered backreference past group 99 of the merged grammar; "
+                             "use a named group")
+        return rf'(?:\{number})'
+    return _GROUP_REFERENCE.sub(shift, template)
+
+
+def _expand(template: str, m) -> str:
+    return m.expand(template)
+
+
+def _own_match(own, replace, m):
+    # A callable replacement sees the match of its rule's own pattern, so
+    # that its numbered groups are the rule's
+    return replace(own.match(m.string, m.start()))
+
+
+@functools.lru_cache(maxsize=8)
+def compile_rules(rules: tuple, backend: str = None) -> RuleSet:
+    """
+    Merge a rule table into the token grammar of the single-pass converter.
+
+    Whitespace runs (blockquote indentation, tab/NBSP collapse, blank line
+    collapse, trailing spaces) and plain text are always part of the grammar;
+    text runs extend up to the next trigger character of any rule, so ordinary
+    prose (including single newlines between non-blank lines) is copied in
+    large runs. Numbered groups of each rule are renumbered to its place in
+    the merged grammar. The patterns are compiled with the regex_backend()
+    named by backend.
+    """
+    engine = regex_backend(backend)
+    triggers = {}
+    line_triggers = {}
+    stages = {"space": "scan.whitespace", "text": "scan.text"}
+    alternatives = []
+    groups = 0
+    replacements = {}
+    handlers = {}
+    for rule in rules:
+        stage = "scan." + rule.name
+        stages.update(dict.fromkeys(rule.triggers, stage))
+        if rule.pattern is None:
+            triggers.update(dict.fromkeys(rule.triggers))
+            handlers.update(dict.fromkeys(rule.triggers, rule.replace))
+            continue
+        if rule.pattern.startswith(_LINE_ANCHOR):
+            line_triggers.update(dict.fromkeys(rule.triggers))
+        else:
+            triggers.update(dict.fromkeys(rule.triggers))
+        offset = groups + 1
+        own = re.compile(rule.pattern)
+        alternatives.append(f"(?P<{rule.name}>{_renumber(rule.pattern, offset, True)})")
+        groups = offset + own.groups
+        stages[rule.name] = stage
+        replace = rule.replace
+        if callable(replace):
+            if own.groups > len(own.groupindex):
+                replace = functools.partial(_own_match, engine.compile(rule.pattern), replace)
+        elif "\\" in replace:
+            # Match.expand() parses its template on every call
+            replace = functools.partial(_expand, _renumber(replace, offset, False))
+        replacements[rule.name] = replace
+    special = re.escape("".join(triggers))
+    line_special = re.escape("".join(line_triggers))
+    # A text run ends on a visible character, so trailing spaces are left to
+    # the whitespace rule, or on the single newline after one. It may start
+    # with plain spaces unless they lead to a ">" (a blockquote at a line
+    # start), continue over a single newline unless the next line starts with
+    # a line-anchored rule's trigger, and over tabs and non-breaking spaces,
+    # which are collapsed in the run. Long runs keep the token count, and so
+    # the per-token work of _scan(), low on densely marked-up text.
+    tail = f'(?:[^{special}{_RUN_BREAK}]*[^{_WHITESPACE}{special}])?'
+    chunk = f'(?:[ ]*[^{_WHITESPACE}{special}>]|[^{_WHITESPACE}{special}])' + tail
+    line = f'[^{line_special}{_WHITESPACE}{special}]' + tail
+    alternatives.append(f'(?P<text>{chunk}(?:\n{line})*\n?)')
+    # Whitespace that does not lead into text: indentation, line ends,
+    # trailing spaces
+    alternatives.append(f'(?P<space>[{_WHITESPACE}]+)')
+    if special:
+        alternatives.append(f'(?P<mark>[{special}])')
+    # Opening tag of a protected region; parameters stop at "{" so a run of
+    # broken tags cannot make the search quadratic
+    protected = r'\{(' + "|".join(PROTECTED_MACROS) + r')(?::([^{}\n]*))?\}'
+    return RuleSet(engine.compile("|".join(alternatives)), engine.compile(_SPACE_PART),
+                   engine.compile(_TAB_RUN), engine.compile(protected),
+                   replacements, handlers, stages)
+
+
+_DEFAULT_RULES = compile_rules(MARKUP_RULES)
+
+# Characters str.splitlines() treats as line boundaries (besides "\n").
+_LINE_BREAKS = frozenset('\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029')
+
+_BACKTICK_RUN = re.compile(r'`{3,}')
+
+
+def _fence(macro: str, params: str, body: str) -> str:
+    """Fenced Markdown block for a protected region, with the language of a {code} macro."""
+    language = ""
+    if macro == "code" and params:
+        for param in params.split("|"):
+            name, sep, value = param.partition("=")
+            if not sep and not language:
+                language = name.strip()
+            elif name.strip() == "language":
+                language = value.strip()
+    # The fence must be longer than any backtick run inside the block
+    longest = max(map(len, _BACKTICK_RUN.findall(body)), default=2) if "```" in body else 2
+    fence = "`" * max(3, longest + 1)
+    body = body.strip("\r\n")
+    return f"{fence}{language}\n{body}\n{fence}"
+
+
+@_profiled("atlassian_to_markdown")
+def atlassian_to_markdown(text: str, rules: tuple = None, backend: str = None) -> str:
     """
     Converts Atlassian wiki-style markup to standard Markdown.
+
+    {code} and {noformat} regions are found first and passed through verbatim
+    as fenced blocks; the prose between them is scanned once, left to right.
+    On text without such regions and with the default MARKUP_RULES the result
+    is identical to the original chain of substitutions kept in
+    _atlassian_to_markdown_regex(). rules replaces that table (pass
+    MARKUP_RULES + (MarkupRule(...),) to add a rule), and backend names the
+    regex engine to match with (see regex_backend()).
+
+    Jira REST API v3 returns rich-text fields as ADF trees instead of markup;
+    a dict is handed to adf_to_markdown() and never reaches the regex path.
+    An empty field, which Jira sends as null, converts to "".
+    """
+    if text is None:
+        return ""
+    if isinstance(text, dict):
+        return adf_to_markdown(text)
+    if rules is None and backend is None:
+        ruleset = _DEFAULT_RULES
+    else:
+        ruleset = compile_rules(tuple(MARKUP_RULES if rules is None else rules), backend)
+    # Normalize line breaks: a literal "\n" is a newline
+    text = text.replace('\\n', '\n')
+
+    # Split off protected regions. An opening tag without a closing one is
+    # left to the prose; once a macro has no closing tag ahead, later tags of
+    # that macro are not searched again, so this stays linear. One finditer
+    # walks the tags: re2's search(text, pos) re-encodes the whole text on
+    # every call. A tag ends at its first "}", so no match straddles the end
+    # of a region and skipping the ones inside it loses nothing.
+    blocks = []
+    prose_start = pos = 0
+    unclosed = set()
+    for m in ruleset.protected.finditer(text):
+        if m.start() < pos:
+            continue
+        macro = m.group(1)
+        close = -1 if macro in unclosed else text.find("{" + macro + "}", m.end())
+        if close == -1:
+            unclosed.add(macro)
+            continue
+        blocks.append(_scan(text[prose_start:m.start()], ruleset))
+        started = time.perf_counter()
+        fenced = _fence(macro, m.group(2), text[m.end():close])
+        blocks.append(fenced)
+        if _profile is not None:
+            _profile.record("scan.protected", time.perf_counter() - started,
+                            close - m.start(), len(fenced))
+        prose_start = pos = close + len(macro) + 2
+    if not blocks:
+        return _scan(text, ruleset)
+    blocks.append(_scan(text[prose_start:], ruleset))
+    return "\n\n".join(block for block in blocks if block)
+
+
+def _scan(text: str, ruleset: RuleSet) -> str:
+    """The single-pass conversion of prose (text without protected regions)."""
+    replacements = ruleset.replacements
+    handlers = ruleset.handlers
+    stages = ruleset.stages
+    space_parts = ruleset.space.findall
+    collapse_tabs = ruleset.tabs.sub
+    out = []
+    emit = out.append
+    pending = []       # trailing whitespace, dropped if the line ends here
+    nl_run = 0         # consecutive "\n" just written (blank line collapse)
+    after_cr = False   # last boundary was "\r", so a following "\n" pairs with it
+    state = ScanState(len(text))
+    skip_until = 0     # tokens up to here are dropped (a copy of state.skip_until)
+    profile = _profile
+    if profile is not None:
+        perf_counter = time.perf_counter
+        stage = None
+        stage_start = perf_counter()
+
+    for m in ruleset.token.finditer(text):
+        start, stop = m.span()
+        kind = m.lastgroup
+
+        if profile is not None:
+            # Charge the time since the previous token to that token's stage
+            now = perf_counter()
+            if stage is not None:
+                written = sum(len(out[i]) for i in range(stage_out, len(out)))
+                profile.record(stage, now - stage_start, stage_bytes, written)
+            stage = stages[kind if kind != 'mark' else text[start]]
+            stage_bytes = stop - start
+            stage_out = len(out)
+            stage_start = now
+
+        # Token kinds are tested from the most to the least frequent one in
+        # dense markup; every token costs a few of these branches.
+        if kind == 'text':
+            if start < skip_until:
+                continue
+            piece = text[start:stop]
+            if '\t' in piece or '\xa0' in piece:
+                piece = collapse_tabs(' ', piece)
+            if pending:
+                out.extend(pending)
+                pending.clear()
+            emit(piece)
+            nl_run = 1 if piece.endswith('\n') else 0
+            after_cr = False
+            continue
+
+        elif kind == 'space':
+            if start < skip_until:
+                continue
+            piece = text[start:stop]
+            if text.startswith('>', stop):
+                # Blockquotes: whitespace from a line start up to ">" is removed
+                if start == 0 or text[start - 1] == '\n':
+                    continue
+                first = piece.find('\n')
+                if first != -1:
+                    piece = piece[:first + 1]
+            # Single newlines and spaces make up most whitespace runs
+            if piece == '\n' and not after_cr:
+                if nl_run < 2:
+                    nl_run += 1
+                    pending.clear()
+                    emit('\n')
+                continue
+            if piece == ' ':
+                pending.append(' ')
+                nl_run = 0
+                after_cr = False
+                continue
+            for spaces, tabs, newline, other in space_parts(piece):
+                if newline:
+                    # Collapse multiple blank lines to a maximum of 2
+                    if nl_run < 2:
+                        nl_run += 1
+                        pending.clear()
+                        if after_cr:
+                            after_cr = False
+                        else:
+                            emit('\n')
+                elif other in _LINE_BREAKS:
+                    pending.clear()
+                    emit('\n')
+                    nl_run = 0
+                    after_cr = other == '\r'
+                else:
+                    # Remove extra Unicode whitespace characters (e.g.,
+                    # non-breaking spaces and tabs) by turning them into a space
+                    pending.append(' ' if tabs else spaces or other)
+                    nl_run = 0
+                    after_cr = False
+            continue
+
+        elif kind == 'mark':
+            handler = handlers.get(text[start])
+            if handler is None:
+                if start < skip_until:
+                    continue
+                piece = text[start]
+            else:
+                piece = handler(state, text, start)
+                skip_until = state.skip_until
+                if piece is None:
+                    continue
+
+        elif start < skip_until:
+            continue
+
+        else:
+            replace = replacements[kind]
+            piece = replace if isinstance(replace, str) else replace(m)
+            if piece.endswith(' '):
+                # Spaces ending a replacement (e.g. after "#") are trailing
+                # whitespace until something follows on the line
+                kept = piece.rstrip(' ')
+                if kept:
+                    if pending:
+                        out.extend(pending)
+                        pending.clear()
+                    emit(kept)
+                pending.append(piece[len(kept):])
+                nl_run = 0
+                after_cr = False
+                continue
+
+        if pending:
+            out.extend(pending)
+            pending.clear()
+        emit(piece)
+        nl_run = 0
+        after_cr = False
+
+    if profile is not None and stage is not None:
+        written = sum(len(out[i]) for i in range(stage_out, len(out)))
+        profile.record(stage, perf_counter() - stage_start, stage_bytes, written)
+    return ''.join(out).strip()
+
+
+# Inline marks of ADF text nodes and the Markdown wrapped around the text,
+# innermost first. Marks without a Markdown form (underline, textColor,
+# subsup, ...) are dropped; link is applied last, outside all of them.
+_ADF_MARKS = (("code", "`"), ("strike", "~~"), ("em", "*"), ("strong", "**"))
+
+# Inline leaf nodes other than text, rendered from their attrs.
+_ADF_INLINE = {
+    "mention": lambda attrs: attrs.get("text") or "@" + str(attrs.get("id", "")),
+    "emoji": lambda attrs: attrs.get("text") or attrs.get("shortName", ""),
+    "status": lambda attrs: attrs.get("text", ""),
+    "date": lambda attrs: time.strftime("%Y-%m-%d",
+                                        time.gmtime(int(attrs.get("timestamp", 0)) / 1000)),
+    "inlineCard": lambda attrs: attrs.get("url", ""),
+    "media": lambda attrs: "![]({})".format(
+        attrs.get("url", "") if attrs.get("type") == "external"
+        else attrs.get("alt") or attrs.get("id", "")),
+    "placeholder": lambda attrs: "",
+}
+
+# Node types laid out as blocks, i.e. separated from their neighbours by a
+# blank line. Children of any other node are written in place.
+_ADF_BLOCKS = frozenset((
+    "doc", "paragraph", "heading", "blockquote", "panel", "codeBlock", "rule",
+    "bulletList", "orderedList", "taskList", "decisionList", "table",
+    "mediaSingle", "mediaGroup", "expand", "nestedExpand", "blockCard", "embedCard",
+    "layoutSection", "layoutColumn", "bodiedExtension",
+))
+
+_ADF_LISTS = {"bulletList", "orderedList", "taskList", "decisionList"}
+
+
+def _adf_text(node: dict, in_cell: bool) -> str:
+    text = node.get("text", "")
+    if in_cell:
+        text = text.replace("|", "\\|").replace("\n", "<br>")
+    marks = node.get("marks")
+    if not marks or not text:
+        return text
+    marks = {mark.get("type"): mark for mark in marks if isinstance(mark, dict)}
+    # Emphasis cannot start or end on whitespace, so keep it outside the marks
+    core = text.strip()
+    if not core:
+        return text
+    for name, fence in _ADF_MARKS:
+        if name in marks:
+            core = f"{fence}{core}{fence}"
+    if "link" in marks:
+        core = f"[{core}]({(marks['link'].get('attrs') or {}).get('href', '')})"
+    start = len(text) - len(text.lstrip())
+    return text[:start] + core + text[start + len(text.strip()):]
+
+
+def _adf_marker(kind: str, item: dict, number: int) -> str:
+    """Markdown marker opening one item of a list node."""
+    if kind == "orderedList":
+        return f"{number}. "
+    if kind == "taskList":
+        return "- [x] " if (item.get("attrs") or {}).get("state") == "DONE" else "- [ ] "
+    return "- "
+
+
+@_profiled("adf_to_markdown")
+def adf_to_markdown(doc: dict) -> str:
+    """
+    Render an Atlassian Document Format tree (Jira REST API v3) as Markdown.
+
+    The tree is walked with an explicit stack rather than by recursion, so
+    deeply nested lists and quotes cannot hit the recursion limit, and every
+    piece of output is appended to a single buffer. Node types without a
+    Markdown form keep the text of their children.
+    """
+    out = []
+    emit = out.append
+    prefixes = []   # line prefixes of the enclosing blockquotes and list items
+    indent = ""     # "".join(prefixes)
+    sep = None      # owed before the next block; None at the start of a container
+    cells = 0       # table cell nesting; line breaks inside a cell become <br>
+    stack = [("node", doc)]
+    while stack:
+        op, value = stack.pop()
+        if op == "emit":
+            emit(value)
+            continue
+        if op == "end":
+            sep = value
+            continue
+        if op == "pop":
+            prefixes.pop()
+            indent = "".join(prefixes)
+            continue
+        if op == "cell_end":
+            emit(" |")
+            cells -= 1
+            sep = None
+            continue
+
+        if op == "node":
+            node = value
+            if not isinstance(node, dict):
+                continue
+            kind = node.get("type")
+            attrs = node.get("attrs") or {}
+            content = node.get("content") or ()
+            if kind == "text":
+                emit(_adf_text(node, cells > 0))
+                continue
+            if kind == "hardBreak":
+                emit("<br>" if cells else "\n" + indent)
+                continue
+            if kind in _ADF_INLINE:
+                emit(_ADF_INLINE[kind](attrs))
+                continue
+            if kind not in _ADF_BLOCKS or (kind == "paragraph" and not content):
+                stack.extend(("node", child) for child in reversed(content))
+                continue
+
+        # Start a block (or list item / table row / cell): pay the separator
+        # owed by the previous block in this container first.
+        if sep is not None and op != "cell":
+            if cells:
+                emit("<br>")
+            elif sep == "\n\n" and op == "node":
+                emit("\n" + indent.rstrip() + "\n" + indent)
+            else:
+                emit("\n" + indent)
+        sep = None
+
+        if op == "item":
+            item, marker = value
+            emit(marker)
+            prefixes.append(" " * len(marker))
+            indent = "".join(prefixes)
+            stack += (("end", "\n"), ("pop", None))
+            stack.extend(("node", child) for child in reversed(item.get("content") or ()))
+            continue
+        if op == "row":
+            row, header = value
+            stack.append(("end", "\n"))
+            if header:
+                stack.append(("emit", "\n" + indent + "|" + " --- |" * len(row)))
+            stack.extend(("cell", cell) for cell in reversed(row))
+            emit("|")
+            continue
+        if op == "cell":
+            emit(" ")
+            cells += 1
+            stack.append(("cell_end", None))
+            stack.extend(("node", child) for child in reversed(value.get("content") or ()))
+            continue
+
+        stack.append(("end", "\n\n"))
+        if kind == "heading":
+            if not cells:
+                emit("#" * int(attrs.get("level", 1)) + " ")
+        elif kind == "rule":
+            emit("---")
+        elif kind == "codeBlock":
+            body = "".join(child.get("text", "") for child in content if isinstance(child, dict))
+            emit(_fence("code", attrs.get("language") or "", body)
+                 .replace("\n", "<br>" if cells else "\n" + indent))
+            continue
+        elif kind in ("blockCard", "embedCard"):
+            emit(attrs.get("url", ""))
+            continue
+        elif kind in ("blockquote", "panel"):
+            emit("> ")
+            prefixes.append("> ")
+            indent = "".join(prefixes)
+            stack.append(("pop", None))
+        elif kind in ("expand", "nestedExpand"):
+            if attrs.get("title"):
+                emit(f"**{attrs['title']}**")
+                sep = "\n\n"
+        elif kind in _ADF_LISTS:
+            start = int(attrs.get("order", 1))
+            items = [child for child in content if isinstance(child, dict)]
+            stack.extend(("item", (item, _adf_marker(kind, item, start + i)))
+                         for i, item in reversed(list(enumerate(items))))
+            continue
+        elif kind == "table":
+            rows = [[cell for cell in (row.get("content") or ()) if isinstance(cell, dict)]
+                    for row in content if isinstance(row, dict)]
+            stack.extend(("row", (row, i == 0)) for i, row in reversed(list(enumerate(rows))))
+            continue
+        stack.extend(("node", child) for child in reversed(content))
+    return "".join(out).strip()
+
+
+# HTML elements laid out as blocks, i.e. separated from their neighbours by
+# a blank line, with the layout containers of Confluence storage format.
+# Elements not named here or below keep the text inside them.
+_HTML_BLOCKS = frozenset((
+    "p", "div", "section", "article", "header", "footer", "main", "nav", "aside",
+    "figure", "figcaption", "address", "details", "summary", "dl", "dt", "dd",
+    "center", "form", "fieldset", "ac:layout", "ac:layout-section", "ac:layout-cell",
+))
+
+# Inline elements and the Markdown wrapped around their text.
+_HTML_INLINE = {
+    "strong": "**", "b": "**", "em": "*", "i": "*", "cite": "*",
+    "code": "`", "tt": "`", "kbd": "`", "samp": "`",
+    "s": "~~", "strike": "~~", "del": "~~",
+}
+
+# Elements whose content is not part of the page text.
+_HTML_SKIP = frozenset(("head", "script", "style", "template", "noscript", "title",
+                        "ac:placeholder"))
+
+# Elements that never have an end tag.
+_HTML_VOID = frozenset(("area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+                        "meta", "param", "source", "track", "wbr"))
+
+_HTML_HEADINGS = {"h1": "# ", "h2": "## ", "h3": "### ", "h4": "#### ", "h5": "##### ",
+                  "h6": "###### "}
+
+# Output pieces joined at a time, and pieces kept back from joining.
+_HTML_FOLD = 4096
+_HTML_KEEP = 64
+
+_HTML_SPACE = re.compile(r'[ \t\n\r\f]+')
+_HTML_LANGUAGE = re.compile(r'(?:language|lang|brush)[-:]\s*([\w+#.-]+)')
+
+# Confluence macros rendered as a blockquote, and the label opening it.
+_CONFLUENCE_PANELS = {"info": "Info", "note": "Note", "tip": "Tip", "warning": "Warning",
+                      "panel": ""}
+
+# Macros that render navigation or page chrome; they are dropped whole.
+_CONFLUENCE_DROP = frozenset((
+    "toc", "children", "pagetree", "pagetreesearch", "anchor", "recently-updated",
+    "attachments", "contentbylabel", "livesearch", "create-from-template",
+    "profile-picture", "space-details", "index",
+))
+
+# Macros shown as the value of one parameter, e.g. a jira macro as its key.
+_CONFLUENCE_VALUES = {"jira": "key", "status": "title"}
+
+# Attribute naming the target of each ri: resource.
+_CONFLUENCE_RESOURCES = {
+    "ri:page": "ri:content-title", "ri:blog-post": "ri:content-title",
+    "ri:attachment": "ri:filename", "ri:space": "ri:space-key", "ri:url": "ri:value",
+}
+
+
+class HtmlToMarkdown(html.parser.HTMLParser):
+    """
+    Streaming HTML to Markdown converter, including Confluence storage format.
+
+    feed() takes the page in pieces of any size and close() returns the
+    Markdown. The stdlib event parser reports tags and text as it reaches
+    them and each event appends to a single output buffer, so no tree is
+    built and nothing is converted twice. Layout follows adf_to_markdown():
+    a finished block owes a separator that is paid, together with the
+    blockquote and list prefixes, when the next content arrives, so empty
+    elements leave no stray blank lines. End tags close any elements left
+    open inside them, which covers the optional end tags of HTML.
+
+    Confluence macros are handled from the same events: parameters are
+    collected on a small frame per open macro, code and noformat bodies
+    become fenced blocks, info/note/tip/warning panels blockquotes, expand
+    macros their title and body, and navigation macros such as toc are
+    dropped. Links and images to pages, attachments and users show the
+    resource's name.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []       # recent output pieces
+        self.done = []      # earlier output, joined into chunks of _HTML_FOLD pieces
+        self.open = []      # (tag, kind, value) of the open elements that need closing
+        self.prefixes = []  # line prefixes of the enclosing blockquotes and list items
+        self.indent = ""    # "".join(self.prefixes)
+        self.sep = "\n\n"   # owed before the next content; None inside a line
+        self.gap = ""       # prefix of the blank line in a "\n\n" separator
+        self.marker = ""    # list item marker owed with the next content
+        self.marker_at = 0  # index of the marker's item in prefixes
+        self.lead = ""      # heading or panel label owed with the next content
+        self.fresh = True   # at the start of a line, where whitespace is dropped
+        self.openers = 0    # inline openers written with no text after them yet
+        self.skip = 0
+        self.pre = None     # [language, text pieces] inside <pre> or a macro's plain body
+        self.param = None   # [name, text pieces] inside a macro parameter
+        self.macros = []    # {"name", "params"} per open macro
+        self.cells = 0      # table cell nesting; line breaks inside a cell become <br>
+        self.cell_empty = False
+        self.tables = []    # [rows written, cells in the current row] per open table
+        self.lists = []     # next item number per open list, None if unordered
+
+    def _need(self, sep: str) -> None:
+        if self.marker and self.sep is not None:
+            # The first block of a list item starts on the marker's line
+            return
+        if self.sep is None or len(sep) > len(self.sep):
+            self.sep = sep
+            self.gap = self.indent.rstrip()
+        elif sep == self.sep and len(self.indent.rstrip()) < len(self.gap):
+            # The blank line belongs to the outermost of the two containers
+            self.gap = self.indent.rstrip()
+
+    def _write(self, text: str) -> None:
+        out = self.out
+        if self.cells:
+            if self.sep is not None and not self.cell_empty:
+                out.append("<br>")
+            self.cell_empty = False
+        elif self.sep is not None or self.marker:
+            line = self.indent
+            if self.marker:
+                # The marker takes the place of its item's prefix
+                at = self.marker_at
+                line = ("".join(self.prefixes[:at]) + self.marker
+                        + "".join(self.prefixes[at + 1:]))
+            if not out:
+                out.append(line)
+            else:
+                out[-1] = out[-1].rstrip(" ")
+                if self.sep == "\n\n":
+                    out.append("\n" + self.gap + "\n" + line)
+                else:
+                    out.append("\n" + line)
+            if self.lead:
+                out.append(self.lead)
+            self.marker = self.lead = ""
+        self.sep = None
+        if text:
+            out.append(text)
+            if len(out) > _HTML_FOLD + _HTML_KEEP:
+                # Small strings cost more in list slots and headers than in
+                # text; the last few stay editable for spacing fixes
+                self.done.append("".join(out[:_HTML_FOLD]))
+                del out[:_HTML_FOLD]
+        self.fresh = False
+
+    def _opener(self, text: str) -> None:
+        self._write(text)
+        self.fresh = True
+        self.openers += 1
+
+    def _closer(self, text: str) -> None:
+        out = self.out
+        if self.openers:
+            # Nothing inside: drop the opener instead of writing "****"
+            out.pop()
+            self.openers -= 1
+        elif out[-1].endswith(" "):
+            # Emphasis cannot end on whitespace, so move it outside
+            out[-1] = out[-1].rstrip(" ")
+            out.append(text + " ")
+        else:
+            out.append(text)
+
+    def handle_data(self, data: str) -> None:
+        if self.skip:
+            return
+        if self.param is not None:
+            self.param[1].append(data)
+            return
+        if self.pre is not None:
+            self.pre[1].append(data)
+            return
+        text = _HTML_SPACE.sub(" ", data)
+        if text[:1] == " ":
+            if self.fresh or self.sep is not None or self.marker:
+                text = text[1:]
+            elif self.openers:
+                # Leading space inside an opener goes before it
+                text = text[1:]
+                if not self.out[-1 - self.openers].endswith(" "):
+                    self.out.insert(len(self.out) - self.openers, " ")
+            elif self.out and self.out[-1].endswith(" "):
+                text = text[1:]
+        if not text:
+            return
+        if self.cells:
+            text = text.replace("|", "\\|")
+        self._write(text)
+        self.openers = 0
+
+    def unknown_decl(self, data: str) -> None:
+        # Macro bodies and link texts of storage format are CDATA sections
+        if data.startswith("CDATA["):
+            self.handle_data(data[6:])
+
+    def _close_to(self, tag: str, stop: tuple = ()) -> bool:
+        """Close the innermost open tag and everything inside it, unless a stop tag comes first."""
+        for i in range(len(self.open) - 1, -1, -1):
+            name = self.open[i][0]
+            if name == tag:
+                while len(self.open) > i:
+                    self._end(*self.open.pop())
+                return True
+            if name in stop:
+                return False
+        return False
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if self.skip:
+            if tag not in _HTML_VOID:
+                self.open.append((tag, "none", None))
+            return
+        if self.param is not None:
+            return
+        if self.pre is not None:
+            if tag == "br":
+                self.pre[1].append("\n")
+            elif tag == "code" and not self.pre[0]:
+                self.pre[0] = self._language(attrs)
+            return
+        if tag in _HTML_INLINE:
+            self._opener(_HTML_INLINE[tag])
+            self.open.append((tag, "inline", _HTML_INLINE[tag]))
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self._opener("[")
+                self.open.append((tag, "link", href))
+        elif tag == "br":
+            if self.cells:
+                if not self.cell_empty:
+                    self.out.append("<br>")
+            elif self.lead or self.sep is not None:
+                pass
+            elif self.open and self.open[-1][1] == "heading":
+                self._write(" ")
+            else:
+                self.out.append("\n" + self.indent)
+                self.fresh = True
+        elif tag == "img":
+            attrs = dict(attrs)
+            self._write(f"![{attrs.get('alt') or ''}]({attrs.get('src') or ''})")
+            self.openers = 0
+        elif tag == "time":
+            self._write(dict(attrs).get("datetime") or "")
+            self.openers = 0
+        elif tag in _HTML_SKIP:
+            self.skip += 1
+            self.open.append((tag, "skip", None))
+        elif tag[:3] in ("ac:", "ri:"):
+            self._confluence(tag, dict(attrs))
+        else:
+            self._block(tag, attrs)
+
+    def _confluence(self, tag: str, attrs: dict) -> None:
+        """Start an element of Confluence storage format (ac:* and ri:*)."""
+        if tag in ("ac:structured-macro", "ac:macro"):
+            name = (attrs.get("ac:name") or "").lower()
+            if name in _CONFLUENCE_DROP:
+                self.skip += 1
+                self.open.append((tag, "skip", None))
+                return
+            macro = {"name": name, "params": {}}
+            self.macros.append(macro)
+            self.open.append((tag, "macro", macro))
+        elif tag in ("ac:parameter", "ac:task-id", "ac:task-status"):
+            self.param = [attrs.get("ac:name") or "", []]
+            self.open.append((tag, "param", None))
+        elif tag == "ac:plain-text-body":
+            params = self.macros[-1]["params"] if self.macros else {}
+            self._need("\n\n")
+            self.pre = [params.get("language", ""), []]
+            self.open.append((tag, "pre", None))
+        elif tag == "ac:rich-text-body" and self.macros:
+            name = self.macros[-1]["name"]
+            title = self.macros[-1]["params"].get("title", "")
+            if name in _CONFLUENCE_PANELS:
+                label = ": ".join(part for part in (_CONFLUENCE_PANELS[name], title) if part)
+                self._need("\n\n")
+                self.prefixes.append("> ")
+                self.indent = "".join(self.prefixes)
+                self.lead = f"**{label}** " if title else f"**{label}:** " if label else ""
+                self.open.append((tag, "quote", None))
+            elif name == "expand" and title:
+                self._need("\n\n")
+                self._write(f"**{title}**")
+                self._need("\n\n")
+        elif tag == "ac:link":
+            self.open.append((tag, "resource", {"name": "", "href": None, "at": self._written()}))
+        elif tag == "ac:image":
+            self.open.append((tag, "image", {"name": "", "href": None,
+                                             "alt": attrs.get("ac:alt") or ""}))
+        elif tag[:3] == "ri:":
+            if not self.open or self.open[-1][1] not in ("resource", "image"):
+                return
+            target = self.open[-1][2]
+            if tag == "ri:user":
+                name = attrs.get("ri:username") or attrs.get("ri:userkey") or attrs.get(
+                    "ri:account-id")
+                name = name and "@" + name
+            else:
+                name = attrs.get(_CONFLUENCE_RESOURCES.get(tag, ""))
+            if tag == "ri:url" and name and target["href"] is None:
+                target["href"] = name
+                if self.open[-1][1] == "resource":
+                    self._opener("[")
+            if name and not target["name"]:
+                target["name"] = name
+        elif tag == "ac:emoticon":
+            if attrs.get("ac:emoji-fallback"):
+                self._write(attrs["ac:emoji-fallback"])
+                self.openers = 0
+        else:
+            # Layout and task lists; anything else (link and task bodies,
+            # inline comment markers) keeps its text
+            self._block(tag, list(attrs.items()))
+
+    def _block(self, tag: str, attrs: list) -> None:
+        if tag in _HTML_BLOCKS or tag in _HTML_HEADINGS or tag in (
+                "blockquote", "pre", "hr", "ul", "ol", "li", "table",
+                "ac:task-list", "ac:task"):
+            # A block ends an open paragraph
+            if self.open and self.open[-1][0] == "p":
+                self._end(*self.open.pop())
+            # and a panel label owed to a heading, list or table gets its own line
+            if self.lead and tag not in _HTML_BLOCKS:
+                self._write("")
+        if tag in _HTML_BLOCKS:
+            self._need("\n\n")
+            self.open.append((tag, "block", None))
+        elif tag in _HTML_HEADINGS:
+            self._need("\n\n")
+            if not self.cells:
+                self.lead = _HTML_HEADINGS[tag]
+            self.open.append((tag, "heading", None))
+        elif tag == "blockquote":
+            self._need("\n\n")
+            self.prefixes.append("> ")
+            self.indent = "".join(self.prefixes)
+            self.open.append((tag, "quote", None))
+        elif tag == "pre":
+            self._need("\n\n")
+            self.pre = [self._language(attrs), []]
+            self.open.append((tag, "pre", None))
+        elif tag == "hr":
+            self._need("\n\n")
+            self._write("---")
+            self._need("\n\n")
+        elif tag in ("ul", "ol", "ac:task-list"):
+            self._need("\n" if self.lists else "\n\n")
+            start = dict(attrs).get("start") or "1"
+            self.lists.append(int(start) if tag == "ol" and start.isdigit() else None)
+            self.open.append((tag, "list", None))
+        elif tag in ("li", "ac:task"):
+            self._close_to(tag, ("ul", "ol", "ac:task-list"))
+            if self.marker:
+                # The enclosing item had no text of its own
+                self._write("")
+            number = self.lists[-1] if self.lists else None
+            if tag == "ac:task":
+                # "- [x] " once ac:task-status says the task is complete
+                self.marker = "- [ ] "
+            elif number is None:
+                self.marker = "- "
+            else:
+                self.marker = f"{number}. "
+                self.lists[-1] += 1
+            self._need("\n")
+            self.marker_at = len(self.prefixes)
+            self.prefixes.append(" " * len(self.marker))
+            self.indent = "".join(self.prefixes)
+            self.open.append((tag, "item", None))
+        elif tag == "table":
+            self._need("\n\n")
+            self.tables.append([0, 0])
+            self.open.append((tag, "table", None))
+        elif tag == "tr" and self.tables:
+            self._close_to("tr", ("table",))
+            self._need("\n")
+            self._write("|")
+            self.open.append((tag, "row", None))
+        elif tag in ("td", "th") and self.tables and self.open[-1][1] in ("row", "cell"):
+            if self.open[-1][1] == "cell":
+                self._end(*self.open.pop())
+            self.out.append(" ")
+            self.tables[-1][1] += 1
+            self.cells += 1
+            self.cell_empty = True
+            self.fresh = True
+            self.sep = None
+            self.open.append((tag, "cell", None))
+
+    @staticmethod
+    def _language(attrs: list) -> str:
+        match = _HTML_LANGUAGE.search(dict(attrs).get("class") or "")
+        return match.group(1) if match else ""
+
+    def handle_endtag(self, tag: str) -> None:
+        self._close_to(tag)
+
+    def _end(self, tag: str, kind: str, value) -> None:
+        if kind == "inline":
+            self._closer(value)
+        elif kind == "link":
+            self._closer(f"]({value})")
+        elif kind == "block":
+            self._need("\n\n")
+        elif kind == "heading":
+            self.lead = ""
+            self._need("\n\n")
+        elif kind == "quote":
+            self.prefixes.pop()
+            self.indent = "".join(self.prefixes)
+            self.lead = ""
+            self._need("\n\n")
+        elif kind == "pre":
+            language, pieces = self.pre
+            self.pre = None
+            body = "".join(pieces)
+            # A newline right after <pre> is not part of the content
+            if body.startswith("\n"):
+                body = body[1:]
+            self._write(_fence("code", language, body)
+                        .replace("\n", "<br>" if self.cells else "\n" + self.indent))
+            self._need("\n\n")
+        elif kind == "list":
+            self.lists.pop()
+            self._need("\n\n")
+        elif kind == "item":
+            self.prefixes.pop()
+            self.indent = "".join(self.prefixes)
+            if self.marker:
+                self.marker = ""
+            else:
+                self.sep = "\n"
+        elif kind == "table":
+            self.tables.pop()
+            self._need("\n\n")
+        elif kind == "row":
+            table = self.tables[-1]
+            if not table[0]:
+                self.out.append("\n" + self.indent + "|" + " --- |" * table[1])
+            table[0] += 1
+            table[1] = 0
+            self.sep = "\n"
+        elif kind == "cell":
+            self.out.append(" |")
+            self.cells -= 1
+            self.sep = None
+        elif kind == "skip":
+            self.skip -= 1
+        elif kind == "param":
+            name, pieces = self.param
+            self.param = None
+            text = "".join(pieces).strip()
+            if tag == "ac:task-status":
+                if text == "complete" and self.marker == "- [ ] ":
+                    self.marker = "- [x] "
+            elif tag == "ac:parameter" and self.macros:
+                self.macros[-1]["params"].setdefault(name, text)
+        elif kind == "macro":
+            self.macros.pop()
+            field = _CONFLUENCE_VALUES.get(value["name"])
+            if field and value["params"].get(field):
+                self._write(value["params"][field])
+        elif kind == "resource":
+            if value["href"] is not None:
+                if self.openers:
+                    # No link text: show the URL itself
+                    self._closer("")
+                    self._write(value["href"])
+                else:
+                    self._closer(f"]({value['href']})")
+            elif self._written() == value["at"] and value["name"]:
+                self._write(value["name"])
+        elif kind == "image":
+            source = value["href"] or value["name"]
+            if source:
+                self._write(f"![{value['alt']}]({source})")
+        self.openers = 0
+
+    def _written(self) -> int:
+        """Number of output pieces so far."""
+        return len(self.done) * _HTML_FOLD + len(self.out)
+
+    def close(self) -> str:
+        super().close()
+        while self.open:
+            self._end(*self.open.pop())
+        self.done.append("".join(self.out))
+        self.out = []
+        return "".join(self.done).strip()
+
+
+@_profiled("html_to_markdown")
+def html_to_markdown(html_data: str, chunk_size: int = 1 << 16) -> str:
+    """
+    Convert an HTML page, e.g. a Confluence body.storage value, to Markdown.
+
+    The page is fed to HtmlToMarkdown in chunk_size pieces, the way it would
+    arrive from a socket, so the parser's pending input stays small.
+    """
+    converter = HtmlToMarkdown()
+    for start in range(0, len(html_data or ""), chunk_size):
+        converter.feed(html_data[start:start + chunk_size])
+    return converter.close()
+
+
+def format_comment(comment: dict, convert=atlassian_to_markdown) -> str:
+    """
+    Format one comment as a markdown block with display name and converted body.
+    """
+    name = (comment.get("author") or {}).get("displayName", "Unknown Author")
+    body_raw = comment.get("body") or ""
+    body_md = convert(body_raw)
+    return f"### {name}\n\n{body_md}\n"
+
+
+# Markup stripped from the raw body of a digested comment: macros, images,
+# user mentions, heading markers, emphasis characters and dividers. A macro
+# or mention stops at the next opening bracket, so a line of unclosed ones
+# is not rescanned from each of them.
+_DIGEST_MARKUP = re.compile(r'\{[a-z]+(?::[^{}\n]*)?\}|![^!\s|]+(?:\|[^!\n]*)?!|\[~[^\[\]\n]*\]'
+                            r'|(?m:^)[ \t]*h[1-6]\.|[*+{}|>\[\]]+|\\-+')
+_SENTENCE_END = re.compile(r'[.!?](?=\s)|\n[ \t]*\n')
+
+# Characters of a comment body read for its digest, and the digest's
+# shortest and longest text.
+_DIGEST_SCAN = 400
+_DIGEST_MIN = 40
+_DIGEST_WIDTH = 160
+
+
+def _adf_prefix(doc: dict, limit: int) -> str:
+    """Roughly the first limit characters of text in an ADF tree, one block per line."""
+    parts = []
+    size = 0
+    stack = [doc]
+    while stack and size < limit:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        if node.get("type") == "text":
+            parts.append(node.get("text", ""))
+            size += len(parts[-1])
+        elif node.get("type") in ("paragraph", "heading", "hardBreak"):
+            parts.append("\n\n")
+        stack.extend(reversed(node.get("content") or ()))
+    return "".join(parts)
+
+
+def comment_digest(comment: dict) -> str:
+    """
+    One-line digest of a comment: author, date and the first sentence of its
+    body, read from the start of the raw markup (or ADF) without converting it.
+    """
+    name = (comment.get("author") or {}).get("displayName", "Unknown Author")
+    body = comment.get("body") or ""
+    if isinstance(body, dict):
+        text = _adf_prefix(body, _DIGEST_SCAN)
+    else:
+        text = _DIGEST_MARKUP.sub(" ", body[:_DIGEST_SCAN].replace('\\n', '\n'))
+    # Stop after the first sentence, unless it is only a greeting or a label
+    pos = 0
+    for end in _SENTENCE_END.finditer(text):
+        pos = end.end()
+        if len(text[:pos].strip()) >= _DIGEST_MIN:
+            text = text[:pos]
+            break
+    text = " ".join(text.split())
+    if len(text) > _DIGEST_WIDTH:
+        text = text[:_DIGEST_WIDTH].rsplit(" ", 1)[0] + " …"
+    created = comment.get("created")
+    when = f" ({created[:10]})" if created else ""
+    return f"- {name}{when}: {text}"
+
+
+def _created(comment: dict) -> Optional[float]:
+    """
+    A comment's "2025-03-27T21:33:45.578-0700" created time as a POSIX
+    timestamp, or None if it is missing or malformed.
+    """
+    try:
+        return datetime.datetime.strptime(comment["created"], "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _window_start(comments: list, recent: int, max_age_days: float) -> int:
+    """Index of the oldest comment within the last `recent` and max_age_days of the newest."""
+    start = 0
+    if recent is not None:
+        start = max(start, len(comments) - recent)
+    if max_age_days is not None:
+        newest = _created(comments[-1])
+        if newest is not None:
+            cutoff = newest - max_age_days * 86400
+            while start < len(comments):
+                created = _created(comments[start])
+                if created is not None and created >= cutoff:
+                    break
+                start += 1
+    # The newest comment is always shown in full
+    return min(start, len(comments) - 1)
+
+
+# Characters of raw markup per token in the low guess format_comments_display()
+# makes before converting a comment: prose averages 5-6 including spaces, so
+# only comments well over the token budget are skipped unconverted.
+_RAW_CHARS_PER_TOKEN = 8
+
+
+@_profiled("format_comments_display")
+def format_comments_display(comments: list, convert=atlassian_to_markdown, recent: int = None,
+                            max_age_days: float = None, token_budget: int = None) -> str:
+    """
+    Format a list of comments to simple markdown with display name and converted body.
+
+    With any of recent, max_age_days or token_budget, only a window of the
+    newest comments is converted in full: at most the last `recent`, those
+    created within max_age_days of the newest comment, and as many of them
+    (newest first) as fit in token_budget estimated tokens. Older comments
+    are listed ahead of the window as one comment_digest() line each, which
+    never runs the converter. The newest comment is always shown in full.
+    """
+    if not comments or (recent is None and max_age_days is None and token_budget is None):
+        return "\n---\n".join(format_comment(comment, convert) for comment in comments)
+    blocks = []
+    used = 0
+    for comment in reversed(comments[_window_start(comments, recent, max_age_days):]):
+        if token_budget is not None and blocks:
+            # A comment already over budget by its raw length is not converted
+            body = comment.get("body")
+            if isinstance(body, str) and used + len(body) // _RAW_CHARS_PER_TOKEN > token_budget:
+                break
+        block = format_comment(comment, convert)
+        if token_budget is not None:
+            used += estimate_tokens(block)
+            if used > token_budget and blocks:
+                break
+        blocks.append(block)
+    older = comments[:len(comments) - len(blocks)]
+    if older:
+        blocks.append(f"### Earlier comments ({len(older)})\n\n"
+                      + "\n".join(comment_digest(comment) for comment in older) + "\n")
+    return "\n---\n".join(reversed(blocks))
+
+
+# Lines the log compactor treats as log output: a clock time or date, a log
+# level, or a Java/Python stack frame. Other lines only collapse when they
+# repeat exactly, so tables and lists with similar rows are left alone.
+_LOG_LINE = re.compile(r'\d{1,2}:\d{2}:\d{2}|\d{4}-\d{2}-\d{2}'
+                       r'|\b(?:TRACE|DEBUG|INFO|NOTICE|WARN|WARNING|ERROR|FATAL|CRITICAL)\b')
+_STACK_FRAME = re.compile(r'\s*(?:at [\w$.<>/]+\(|\.\.\. \d+ (?:more|common frames)'
+                          r'|File "[^"]*", line \d+)')
+# Parts of a log line that vary between otherwise identical lines: MAC
+# addresses, hex ids and numbers (which covers timestamps, pids and ports).
+# A hex id is a whole word of 8 or more hex digits with at least one decimal
+# digit; the look-ahead keeps the word from being split two ways, which would
+# backtrack quadratically on a long run of digits.
+_LOG_VARIABLE = re.compile(r'[0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5}|0x[0-9a-fA-F]+'
+                           r'|\b(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{8,}\b|\d+')
+
+# Lines kept at the start and end of a collapsed run, and the line that
+# stands in for the rest.
+_LOG_HEAD = 2
+_LOG_TAIL = 2
+_LOG_MARKER = "…{} similar lines…"
+
+
+def _marker_size(dropped: int) -> int:
+    """UTF-8 bytes of the marker for dropped lines, with its newline."""
+    return len(_LOG_MARKER.format(dropped).encode("utf-8")) + 1
+
+
+def _line_shape(line: str) -> str:
+    """What similar lines have in common, or None for a blank line, which never joins a run."""
+    if not line.strip():
+        return None
+    if _STACK_FRAME.match(line):
+        return "\0frame"
+    if _LOG_LINE.search(line):
+        return _LOG_VARIABLE.sub("#", line)
+    return line
+
+
+def compact_lines(lines, report: list = None):
+    """
+    Collapse runs of similar log lines in a stream of lines.
+
+    Consecutive lines with the same shape (log lines equal once numbers,
+    timestamps, MACs and hex ids are masked; any stack frames; other
+    non-blank lines only when identical) are reduced to their first _LOG_HEAD and last
+    _LOG_TAIL lines around a "…N similar lines…" marker, unless the marker
+    would be longer than the lines it replaces. Yields the output lines while
+    reading, holding only the current run's head and tail. If
+    report is a list, the UTF-8 bytes dropped (net of markers) are appended
+    to it once the stream ends.
+    """
+    saved = 0
+    shape = None
+    head = []
+    tail = collections.deque(maxlen=_LOG_TAIL + 2)
+    held = []
+    dropped = 0
+    dropped_size = 0
+    for line in itertools.chain(lines, (None,)):
+        line_shape = None if line is None else _line_shape(line)
+        if line_shape == shape and line_shape is not None:
+            if len(head) < _LOG_HEAD:
+                head.append(line)
+            else:
+                if len(tail) == tail.maxlen:
+                    dropped += 1
+                    dropped_size += len(tail[0].encode("utf-8", "surrogatepass")) + 1
+                    # Keep dropped lines until they outweigh the marker; each
+                    # line adds more bytes than the marker can grow, so once
+                    # they do, they always will.
+                    held.append(tail[0])
+                    if dropped_size > _marker_size(dropped):
+                        held.clear()
+                tail.append(line)
+            continue
+        # The run ended: flush it, collapsing it if that drops 3 or more lines
+        # and the marker is shorter than what it replaces
+        yield from head
+        if dropped:
+            for _ in range(len(tail) - _LOG_TAIL):
+                dropped += 1
+                held.append(tail.popleft())
+                dropped_size += len(held[-1].encode("utf-8", "surrogatepass")) + 1
+            if dropped_size > _marker_size(dropped):
+                saved += dropped_size - _marker_size(dropped)
+                yield _LOG_MARKER.format(dropped)
+            else:
+                yield from held
+        yield from tail
+        if line is None:
+            break
+        shape = line_shape
+        head = [line]
+        tail.clear()
+        held = []
+        dropped = dropped_size = 0
+    if report is not None:
+        report.append(saved)
+
+
+def compact_logs(text: str) -> tuple:
+    """
+    compact_lines() over a markup field; returns (compacted text, bytes saved).
+    """
+    if not isinstance(text, str):
+        return text, 0
+    report = []
+    compacted = "\n".join(compact_lines(text.replace('\\n', '\n').split("\n"), report))
+    return compacted, report[0]
+
+
+class LogCompactor:
+    """
+    Converter wrapper that runs compact_logs() on each markup field before
+    converting it, so pasted device logs, HAR excerpts and stack traces cost
+    neither conversion time nor prompt tokens. bytes_saved accumulates the
+    bytes removed; reset it between tickets to report per ticket.
+    Instances are callables, so they can be passed wherever
+    atlassian_to_markdown is expected.
+    """
+
+    def __init__(self, convert=atlassian_to_markdown):
+        self.convert = convert
+        self.bytes_saved = 0
+
+    def __call__(self, text: str) -> str:
+        compacted, saved = compact_logs(text)
+        self.bytes_saved += saved
+        return self.convert(compacted)
+
+
+# Token budget for a whole ticket on the 8k num_ctx Ollama nodes, leaving
+# room for the model's answer.
+TICKET_TOKEN_BUDGET = 6144
+
+# Tokens held back from the budget for the instructions an LLM node wraps
+# around the ticket (the summary prompt is about 30).
+PROMPT_TOKEN_RESERVE = 128
+
+# Pieces counted as one token by estimate_tokens(): up to eight Latin or
+# three Greek/Cyrillic letters, up to three digits, a run of one repeated
+# punctuation character, any other letter, or a run of newlines. On ticket
+# text this comes to 0.97-1.12x a real BPE count.
+_TOKEN_PIECE = re.compile(r'[A-Za-z\xc0-\u024f]{1,8}|[\u0370-\u04ff]{1,3}|\d{1,3}'
+                          r'|([^\w\s])\1*|[^\W\d]|\n+')
+
+# Ticket sections in the order the budget is handed out, with the share of
+# a cut section kept from its end: comments keep the latest discussion,
+# everything else its beginning.
+TICKET_SECTIONS = (
+    ("summary", 0.0),
+    ("root_cause", 0.0),
+    ("description", 0.0),
+    ("comments", 0.67),
+)
+
+# Tokens held back for each lower-priority section, so a long description
+# cannot push the comments out entirely. Small budgets hold back less, see
+# fit_ticket().
+_SECTION_FLOOR = 512
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate LLM token count of text without a tokenizer."""
+    return len(_TOKEN_PIECE.findall(text))
+
+
+def _elision(tokens: int) -> str:
+    return f"\n[… {tokens} tokens truncated …]\n"
+
+
+def truncate_to_tokens(text: str, budget: int, tail_share: float = 0.0,
+                       cost: int = None) -> str:
+    """
+    Cut text to about budget tokens (as counted by estimate_tokens()),
+    replacing the removed part with a marker. tail_share of the budget is
+    kept from the end of the text and the rest from its start; cuts move to
+    a nearby line break or space. cost is the text's token count
+    if the caller already has it.
+    """
+    if cost is None:
+        cost = estimate_tokens(text)
+    if cost <= budget:
+        return text
+    budget = max(0, budget - estimate_tokens(_elision(cost)))
+    tail = int(budget * tail_share)
+    head = budget - tail
+    # Character offsets where the kept head ends and the kept tail starts
+    head_end, tail_start = 0, len(text)
+    for count, m in enumerate(_TOKEN_PIECE.finditer(text)):
+        if count == head:
+            head_end = m.start()
+        if count == cost - tail:
+            tail_start = m.start()
+            break
+    if count < head:
+        head_end = len(text)
+    # Prefer cutting at a line break, else between words
+    for sep in ("\n", " "):
+        found = text.rfind(sep, 0, head_end)
+        if found > head_end * 4 // 5:
+            head_end = found
+            break
+    for sep in ("\n", " "):
+        found = text.find(sep, tail_start)
+        if found != -1 and found - tail_start < (len(text) - tail_start) // 5:
+            tail_start = found + 1
+            break
+    return text[:head_end].rstrip() + _elision(cost - budget) + text[tail_start:].lstrip()
+
+
+def fit_ticket(sections: dict, budget: int = TICKET_TOKEN_BUDGET) -> dict:
+    """
+    Shrink ticket sections (keys from TICKET_SECTIONS; missing ones are
+    skipped) to fit budget tokens together.
+
+    Sections are visited once, in priority order. Each keeps as much of its
+    text as the budget allows after holding back a floor of tokens for every
+    section still to come, and is cut by truncate_to_tokens() only if it
+    does not fit. The floor is _SECTION_FLOOR, or less when all floors
+    together would take more than half the budget.
+    """
+    order = [(name, tail) for name, tail in TICKET_SECTIONS if name in sections]
+    costs = [estimate_tokens(sections[name]) for name, _ in order]
+    floor = min(_SECTION_FLOOR, budget // (2 * len(order))) if order else 0
+    fitted = dict(sections)
+    remaining = budget
+    for i, (name, tail) in enumerate(order):
+        reserve = sum(min(cost, floor) for cost in costs[i + 1:])
+        allowance = max(0, remaining - reserve)
+        if costs[i] > allowance:
+            fitted[name] = truncate_to_tokens(sections[name], allowance, tail, costs[i])
+            remaining -= allowance
+        else:
+            remaining -= costs[i]
+    return fitted
+
+
+def render_within(render, sections: dict, budget: int = None, reserve: int = 0) -> str:
+    """
+    render(**sections), with the sections first cut by fit_ticket() so that
+    the whole text, render's own layout included, stays within about budget
+    tokens less reserve (tokens kept for text around it, e.g. an LLM
+    prompt). Without a budget the sections are rendered as they are.
+    """
+    if budget is None:
+        return render(**sections)
+    layout = estimate_tokens(render(**dict.fromkeys(sections, "")))
+    return render(**fit_ticket(sections, budget - reserve - layout))
+
+
+# Default token budget of one chunk of a wiki page. The Wiki2Test model runs
+# with num_ctx 8192, which also holds the system prompt and the answer.
+CHUNK_TOKEN_BUDGET = 2048
+
+# Most chunks handed to a Dify iteration: a code node's array outputs are
+# limited to CODE_MAX_STRING_ARRAY_LENGTH items, 30 by default.
+MAX_CHUNKS = 30
+
+# The look-ahead stops the spaces after the hashes from being shared with
+# the title, which backtracks quadratically on a line of "#" and spaces.
+_MD_HEADING = re.compile(r'(#{1,6}) +(?! )(.*\S)')
+_MD_FENCE = re.compile(r'`{3,}')
+
+
+def _markdown_sections(markdown: str):
+    """
+    Split Markdown at headings outside code fences into (path, heading,
+    lines) per section, where path is the (level, title) of the section's
+    heading and of the headings enclosing it.
+    """
+    path = ()
+    heading = ""
+    lines = []
+    fence = None
+    for line in markdown.split("\n"):
+        if fence is not None:
+            if line.startswith(fence) and not line.rstrip().strip("`"):
+                fence = None
+        elif line.startswith("```"):
+            fence = _MD_FENCE.match(line).group(0)
+        else:
+            match = _MD_HEADING.fullmatch(line)
+            if match:
+                if heading or any(part.strip() for part in lines):
+                    yield path, heading, lines
+                level = len(match.group(1))
+                path = tuple(entry for entry in path if entry[0] < level) + (
+                    (level, match.group(2)),)
+                heading = line
+                lines = []
+                continue
+        lines.append(line)
+    if heading or any(part.strip() for part in lines):
+        yield path, heading, lines
+
+
+def _markdown_blocks(lines: list) -> list:
+    """Paragraphs of lines, with each code fence kept in one block."""
+    blocks = []
+    block = []
+    fence = None
+    for line in lines:
+        if fence is not None:
+            if line.startswith(fence) and not line.rstrip().strip("`"):
+                fence = None
+        elif line.startswith("```"):
+            fence = _MD_FENCE.match(line).group(0)
+        elif not line.strip():
+            if block:
+                blocks.append("\n".join(block))
+                block = []
+            continue
+        block.append(line)
+    if block:
+        blocks.append("\n".join(block))
+    return blocks
+
+
+def _split_to_tokens(text: str, budget: int, cost) -> list:
+    """Pieces of text of at most about budget tokens, cut at lines, else anywhere."""
+    pieces = []
+    for line in text.split("\n"):
+        tokens = cost(line)
+        if tokens <= budget:
+            pieces.append(line)
+            continue
+        step = max(1, len(line) * budget // tokens)
+        pieces.extend(line[i:i + step] for i in range(0, len(line), step))
+    return pieces
+
+
+def chunk_markdown(markdown: str, budget: int = CHUNK_TOKEN_BUDGET, cost=estimate_tokens) -> list:
+    """
+    Split converted Markdown (e.g. a wiki page) into chunks of at most
+    about budget tokens, cut at headings.
+
+    Consecutive sections are packed into one chunk while they fit and stay
+    under the heading that encloses the chunk's first section. Every chunk
+    starts with the headings enclosing it, so it can be read on its own; a
+    section too long for one chunk is cut at paragraphs (then lines) and
+    each piece repeats the section's heading. Chunks are dicts with the
+    text, its token count, the heading path as titles, and an id hashed
+    from the text (and, for a repeated text, its occurrence), which stays
+    the same as long as the chunk's text does.
+    """
+    chunks = []
+    seen = collections.Counter()
+
+    def emit(context: tuple, body: str) -> None:
+        text = "\n".join("#" * level + " " + title for level, title in context)
+        text = f"{text}\n\n{body}" if text else body
+        digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=8)
+        if seen[text]:
+            digest.update(b"\0%d" % seen[text])
+        seen[text] += 1
+        chunks.append({
+            "id": digest.hexdigest(),
+            "headings": [title for _, title in context],
+            "text": text,
+            "tokens": cost(text),
+        })
+
+    context = ()    # headings above the pending chunk
+    pending = []    # sections packed into the pending chunk
+    used = 0
+    for path, heading, lines in _markdown_sections(markdown):
+        parents = path[:-1] if heading else path
+        body = "\n".join([heading] + lines if heading else lines).strip("\n")
+        tokens = cost(body) + 1
+        if pending and (used + tokens > budget or parents[:len(context)] != context):
+            emit(context, "\n\n".join(pending))
+            pending = []
+        if not pending:
+            context = parents
+            used = cost("\n".join("#" * level + " " + title for level, title in context)) + 2
+        if used + tokens <= budget:
+            pending.append(body)
+            used += tokens
+            continue
+        # Too long for a chunk of its own: cut it, each piece under the full path
+        context = path
+        overhead = cost("\n".join("#" * level + " " + title for level, title in path)) + 2
+        limit = max(budget - overhead, budget // 4)
+        piece, size, last = "", 0, None
+        for index, block in enumerate(_markdown_blocks(lines)):
+            block_tokens = cost(block) + 1
+            parts = [block] if block_tokens <= limit else _split_to_tokens(block, limit, cost)
+            for part in parts:
+                part_tokens = block_tokens if len(parts) == 1 else cost(part) + 1
+                if piece and size + part_tokens > limit:
+                    emit(context, piece)
+                    piece, size = "", 0
+                if piece:
+                    # Lines of one cut paragraph stay together
+                    piece += "\n" if index == last else "\n\n"
+                piece += part
+                size += part_tokens
+                last = index
+        if piece:
+            emit(context, piece)
+        pending = []
+    if pending:
+        emit(context, "\n\n".join(pending))
+    return chunks
+
+
+def cap_chunks(chunks: list, max_chunks: int = MAX_CHUNKS,
+               budget: int = TICKET_TOKEN_BUDGET) -> list:
+    """
+    Merge runs of adjacent chunk_markdown() chunks so that there are at
+    most max_chunks, each cut by truncate_to_tokens() to about budget
+    tokens if the merge makes it longer. Up to max_chunks chunks come back
+    as they are; a merged chunk keeps the headings of its first one.
+    """
+    if len(chunks) <= max_chunks:
+        return chunks
+    size = -(-len(chunks) // max_chunks)
+    merged = []
+    for start in range(0, len(chunks), size):
+        group = chunks[start:start + size]
+        text = "\n\n".join(chunk["text"] for chunk in group)
+        tokens = sum(chunk["tokens"] for chunk in group) + len(group) - 1
+        if tokens > budget:
+            text = truncate_to_tokens(text, budget, 0.0, tokens)
+            tokens = estimate_tokens(text)
+        digest = hashlib.blake2b(digest_size=8)
+        for chunk in group:
+            digest.update(chunk["id"].encode("ascii"))
+        merged.append({
+            "id": digest.hexdigest(),
+            "headings": group[0]["headings"],
+            "text": text,
+            "tokens": tokens,
+        })
+    return merged
+
+
+def fit_parts(parts: list, budget: int) -> list:
+    """
+    Cut parts (e.g. the answers for each chunk of a page) to fit budget
+    tokens together, one separator token between each. The budget is shared
+    evenly: parts shorter than their share are kept whole and leave the rest
+    to the others, longer ones are cut by truncate_to_tokens() to the share.
+    """
+    costs = [estimate_tokens(part) for part in parts]
+    fitted = list(parts)
+    remaining = budget - max(0, len(parts) - 1)
+    left = len(parts)
+    for i in sorted(range(len(parts)), key=costs.__getitem__):
+        share = max(0, remaining) // left
+        if costs[i] > share:
+            fitted[i] = truncate_to_tokens(parts[i], share, 0.0, costs[i])
+            remaining -= share
+        else:
+            remaining -= costs[i]
+        left -= 1
+    return fitted
+
+# Everything above this line is the shared converter. sync_code_nodes.py
+# copies the parts of it that each Dify code node's main() uses into the
+# node, ahead of main(); a node opts in by starting with
+# sync_code_nodes.HEADER. Edit the converter here and re-run the sync
+# instead of patching the workflows.
+
+
+def _atlassian_to_markdown_regex(text: str) -> str:
+    """
+    Reference implementation of atlassian_to_markdown() as a chain of regex
+    substitutions, kept to check the single-pass converter against.
     """
 
     # Normalize line breaks
@@ -38,28 +1960,70 @@ def atlassian_to_markdown(text: str) -> str:
     return text.strip()
 
 
-def format_comments_display(comments: list) -> str:
+# Parts of an issue payload the formatter reads, plus the ids and timestamps
+# the incremental renderer compares and the comment paging counters.
+# project_issue() drops everything else, and jira_query_params() asks Jira
+# for only these fields.
+ISSUE_PROJECTION = {
+    "key": True,
+    "fields": {
+        "summary": True,
+        "description": True,
+        "customfield_10205": True,
+        "updated": True,
+        "comment": {
+            "comments": {
+                "id": True,
+                "created": True,
+                "updated": True,
+                "author": {"displayName": True},
+                "body": True,
+            },
+            "startAt": True,
+            "maxResults": True,
+            "total": True,
+        },
+    },
+}
+
+
+def _project(value, spec):
+    if spec is True:
+        return value
+    if isinstance(value, list):
+        return [_project(item, spec) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {name: _project(value[name], sub) for name, sub in spec.items() if name in value}
+
+
+def project_issue(issue: dict, projection: dict = None) -> dict:
     """
-    Format a list of comments to simple markdown with display name and converted body.
+    Return a copy of a Jira issue reduced to the fields the formatter uses.
+    """
+    return _project(issue, projection or ISSUE_PROJECTION)
+
+
+def jira_query_params(projection: dict = None) -> dict:
+    """
+    Build the Jira REST `fields` query parameter matching a projection.
+
+    Jira can only select top-level fields, so nested parts (e.g. the comment
+    author) are trimmed afterwards by project_issue(). No `expand` is sent,
+    so Jira leaves out renderedFields, names, schema and changelog, which the
+    formatter never reads. Only jira_fetch sends these parameters: the
+    workflows' get_issue tool node takes nothing but an issue key, and
+    jira_bulk reads exports that were already fetched, trimming them with
+    project_issue().
     """
-    output = []
-    for comment in comments:
-        name = comment.get("author", {}).get("displayName", "Unknown Author")
-        body_raw = comment.get("body", "")
-        body_md = atlassian_to_markdown(body_raw)
-        output.append(f"### {name}\n\n{body_md}\n")
-    return "\n---\n".join(output)
-
-
-def main(jira_response: list) -> dict:
-    """Formats JSON data into a Jira-style ticket string (simplified format)."""
-    issue = jira_response[0]["issue"]
-    jira_ticket = issue["key"]
-    root_cause = atlassian_to_markdown(issue["fields"]["customfield_10205"])
-    description = atlassian_to_markdown(issue["fields"]["description"])
-    comments = format_comments_display(issue["fields"]["comment"]["comments"])
-    summary = issue["fields"]["summary"]
-    ticket = f"""
+    spec = (projection or ISSUE_PROJECTION).get("fields", {})
+    return {"fields": ",".join(spec)}
+
+
+def assemble_ticket(jira_ticket: str, summary: str, root_cause: str, description: str,
+                    comments: str) -> str:
+    """Lay already converted sections out as a Jira-style ticket string."""
+    return f"""
 **Jira Ticket** {jira_ticket}
 
 **Summary:*** {summary}
@@ -76,8 +2040,73 @@ def main(jira_response: list) -> dict:
 {comments}
 """
 
+
+@_profiled("format_issue")
+def format_issue(issue: dict, convert=atlassian_to_markdown, token_budget: int = None) -> str:
+    """
+    Formats a single Jira issue into a ticket string (simplified format).
+
+    convert turns each markup field into Markdown; pass a ConversionCache (or
+    any callable with the same signature) to reuse earlier conversions.
+    With token_budget, the sections are cut by fit_ticket() so that the whole
+    ticket stays within about that many tokens. Fields Jira sends as null
+    are treated as empty.
+    """
+    fields = issue["fields"]
+    sections = {
+        "summary": fields.get("summary") or "",
+        "root_cause": convert(fields.get("customfield_10205") or ""),
+        "description": convert(fields.get("description") or ""),
+        "comments": format_comments_display(
+            (fields.get("comment") or {}).get("comments") or [], convert),
+    }
+    return render_within(functools.partial(assemble_ticket, issue["key"]), sections,
+                         token_budget)
+
+
+def format_issues(issues: list, errors: list = None) -> dict:
+    """
+    Format many Jira issues in one call, keyed by issue key.
+
+    Entries may be bare issues (as in a JQL search result) or wrapped in
+    {"issue": ...} like the get_issue tool output. The converter's compiled
+    token grammar is shared across every issue, so a batch only pays the
+    sandbox and import cost once. An issue that fails to format is left out
+    and, if errors is a list, reported there as a {"key", "error"} record, so
+    one malformed ticket cannot fail the batch.
+    """
+    tickets = {}
+    for entry in issues:
+        issue = entry.get("issue", entry) if isinstance(entry, dict) else entry
+        key = issue.get("key") if isinstance(issue, dict) else None
+        try:
+            tickets[key] = format_issue(issue)
+        except Exception as exc:
+            if errors is not None:
+                errors.append({"key": key, "error": f"{type(exc).__name__}: {exc}"})
+    return tickets
+
+
+@_profiled("main")
+def main(jira_response: list, token_budget: int = None) -> dict:
+    """
+    Formats JSON data into a Jira-style ticket string (simplified format),
+    within token_budget tokens if given (e.g. TICKET_TOKEN_BUDGET).
+    """
     return {
-        "result": ticket
+        "result": format_issue(jira_response[0]["issue"], token_budget=token_budget)
+    }
+
+
+def main_batch(jira_response: list) -> dict:
+    """
+    Formats every issue in a Jira response, keyed by issue key, with a
+    {"key", "error"} record in errors for each issue that could not be.
+    """
+    errors = []
+    return {
+        "result": format_issues(jira_response, errors),
+        "errors": errors,
     }
 
 
@@ -2955,3 +4984,135 @@ if __name__ == "__main__":
 
     result = main(sample_jira_response)
     print(result["result"])
+
+    # A token budget cuts the ticket down, and one it already fits leaves it alone
+    assert estimate_tokens(main(sample_jira_response, token_budget=400)["result"]) <= 400
+    assert main(sample_jira_response, token_budget=10 * TICKET_TOKEN_BUDGET) == result
+
+    # Profiled entry points count the markup they were given, not the wrapper
+    enable_profiling()
+    main(sample_jira_response)
+    stages = disable_profiling().as_dict()
+    assert stages["main"]["bytes_in"] == stages["format_issue"]["bytes_in"] > 10000
+
+    # Null fields format as empty, and a broken issue only costs its own record
+    sparse = {"key": "RKS-0", "fields": {"summary": "Empty", "description": None,
+                                         "customfield_10205": None, "comment": None}}
+    batch = main_batch([{"issue": sparse}, {"issue": {"key": "RKS-1"}}] + sample_jira_response)
+    assert set(batch["result"]) == {"RKS-0", sample_jira_response[0]["issue"]["key"]}
+    assert batch["errors"] == [{"key": "RKS-1", "error": "KeyError: 'fields'"}]
+
+    # Golden-output check: the single-pass converter must match the original
+    # substitution chain on every markup field of the sample ticket. None of
+    # them holds a {code} or {noformat} block, which the chain used to mangle.
+    fields = sample_jira_response[0]["issue"]["fields"]
+    golden_inputs = [fields["description"], fields["customfield_10205"]]
+    golden_inputs += [c["body"] for c in fields["comment"]["comments"]]
+    for raw in golden_inputs:
+        assert atlassian_to_markdown(raw) == _atlassian_to_markdown_regex(raw)
+
+    # Added rules keep their own group numbers, and line-anchored ones match
+    # on every line, not only the first
+    extra = MARKUP_RULES + (
+        MarkupRule("strike", r'-(\w+)-', r'~~\1~~', "-"),
+        MarkupRule("bullet", r'(?m:^)\*[ ]', "- ", "*"),
+    )
+    assert atlassian_to_markdown("a -gone- b\nh2. Title\n* one\n* two", rules=extra) == (
+        "a ~~gone~~ b\n## Title\n- one\n- two")
+
+    # The recent-comment window converts only the comments it shows in full
+    converted = []
+    windowed = format_comments_display(fields["comment"]["comments"],
+                                       lambda body: converted.append(body) or body, recent=3)
+    assert len(converted) == 3 and windowed.startswith("### Earlier comments (22)")
+
+    # A comment crossing the token budget by its raw length is not converted
+    comments = list(fields["comment"]["comments"])
+    huge = comments[-2] = dict(comments[-2], body="log line\n" * 100000)
+    converted = []
+    windowed = format_comments_display(comments, lambda body: converted.append(body) or body,
+                                       token_budget=2000)
+    assert huge["body"] not in converted and huge["body"] not in windowed
+
+    # Repeated log lines collapse around a marker, but never into more bytes
+    # than they had; a long run of digits is masked in linear time
+    log = "\n".join(f"12:00:{i:02d} ERROR 0x{i:04x} retry {i}" for i in range(40))
+    compacted, saved = compact_logs(log)
+    assert compacted.split("\n")[2] == "…36 similar lines…" and saved > 0
+    assert saved == len(log.encode("utf-8")) - len(compacted.encode("utf-8"))
+    assert compact_logs("\n".join(["same"] * 7)) == ("\n".join(["same"] * 7), 0)
+    assert compact_logs("\n".join(["ERROR " + "1" * 100000 + "g"] * 7))[1] > 0
+
+    # REST API v3 sends the same fields as ADF trees, which are rendered
+    # directly. Nesting deeper than the recursion limit must still work.
+    adf = {"type": "doc", "version": 1, "content": [
+        {"type": "heading", "attrs": {"level": 2}, "content": [{"type": "text", "text": "Steps"}]},
+        {"type": "paragraph", "content": [
+            {"type": "text", "text": "Login ", "marks": [{"type": "strong"}]},
+            {"type": "text", "text": "portal", "marks": [{"type": "link", "attrs": {"href": "https://x"}}]},
+        ]},
+        {"type": "bulletList", "content": [
+            {"type": "listItem", "content": [{"type": "paragraph", "content": [{"type": "text", "text": "a"}]}]},
+            {"type": "listItem", "content": [{"type": "paragraph", "content": [{"type": "text", "text": "b"}]}]},
+        ]},
+        {"type": "codeBlock", "attrs": {"language": "java"}, "content": [{"type": "text", "text": "x  = 1"}]},
+    ]}
+    assert atlassian_to_markdown(adf) == (
+        "## Steps\n\n**Login** [portal](https://x)\n\n- a\n- b\n\n```java\nx  = 1\n```")
+    deep = {"type": "paragraph", "content": [{"type": "text", "text": "deep"}]}
+    for _ in range(5000):
+        deep = {"type": "blockquote", "content": [deep]}
+    assert adf_to_markdown(deep).endswith("> > deep")
+
+    # Confluence pages are HTML; the streaming converter gives the same
+    # Markdown however the page is split into chunks.
+    page = ("<h2>Steps</h2><p>Login <strong>portal </strong><a href=\"https://x\">here</a></p>"
+            "<ul><li><p>a</p></li><li>b<ol><li>c</li></ol></li></ul>"
+            "<pre class=\"language-java\">\nx  = 1</pre>"
+            "<table><tr><th>A</th><th>B</th></tr><tr><td>1|2</td><td><p>3</p><p>4</p></td></tr></table>")
+    expected = ("## Steps\n\nLogin **portal** [here](https://x)\n\n- a\n- b\n  1. c\n\n"
+                "```java\nx  = 1\n```\n\n| A | B |\n| --- | --- |\n| 1\\|2 | 3<br>4 |")
+    assert html_to_markdown(page) == expected
+    assert html_to_markdown(page, chunk_size=7) == expected
+
+    # Storage format: macros become compact Markdown, navigation macros go
+    storage = ('<p><ac:structured-macro ac:name="toc"><ac:parameter ac:name="maxLevel">3'
+               '</ac:parameter></ac:structured-macro></p><h1>Portal</h1>'
+               '<ac:structured-macro ac:name="warning"><ac:parameter ac:name="title">Order'
+               '</ac:parameter><ac:rich-text-body><p>Controller first.</p></ac:rich-text-body>'
+               '</ac:structured-macro><p>See <ac:link><ri:page ri:content-title="RADIUS" />'
+               '</ac:link> and <ac:link><ri:attachment ri:filename="plan.pdf" />'
+               '<ac:plain-text-link-body><![CDATA[the plan]]></ac:plain-text-link-body></ac:link>'
+               '</p><ac:structured-macro ac:name="code"><ac:parameter ac:name="language">bash'
+               '</ac:parameter><ac:plain-text-body><![CDATA[[ $a < 3 ] && echo ok]]>'
+               '</ac:plain-text-body></ac:structured-macro><ac:task-list><ac:task><ac:task-id>1'
+               '</ac:task-id><ac:task-status>complete</ac:task-status><ac:task-body>Plan'
+               '</ac:task-body></ac:task></ac:task-list>'
+               '<ac:image ac:alt="topology"><ri:attachment ri:filename="topo.png" /></ac:image>')
+    expected = ("# Portal\n\n> **Warning: Order** Controller first.\n\nSee RADIUS and the plan\n\n"
+                "```bash\n[ $a < 3 ] && echo ok\n```\n\n- [x] Plan\n\n![topology](topo.png)")
+    assert html_to_markdown(storage) == expected
+    assert html_to_markdown(storage, chunk_size=5) == expected
+
+    # Wiki pages are cut at headings into chunks that carry their heading
+    # path; "#" lines inside code fences are not headings
+    wiki = ("# Portal\nintro\n## Login\n```bash\n# not a heading\n```\n## Logout\n"
+            + "step one two three four five\n\n" * 60 + "# Radius\nshared secret")
+    chunks = chunk_markdown(wiki, budget=120)
+    assert all(chunk["tokens"] <= 120 for chunk in chunks)
+    assert chunks[0]["text"].startswith("# Portal\nintro\n\n## Login\n```bash\n# not a heading")
+    assert chunks[1]["headings"] == ["Portal", "Logout"] and chunks[-1]["headings"] == []
+    assert len({chunk["id"] for chunk in chunks}) == len(chunks)
+    assert [chunk["id"] for chunk in chunk_markdown(wiki, budget=120)] == [
+        chunk["id"] for chunk in chunks]
+    assert chunk_markdown("# " + " " * 100000)[0]["headings"] == []
+    # A page with more chunks than a Dify array holds is merged down to the
+    # limit, and per-chunk answers are cut to share one budget
+    capped = cap_chunks(chunks, max_chunks=4, budget=200)
+    assert len(capped) <= 4 and cap_chunks(chunks, len(chunks)) == chunks
+    assert all(chunk["tokens"] <= 200 for chunk in capped)
+    assert capped[0]["text"].startswith(chunks[0]["text"])
+    parts = ["short answer", "long answer " * 400, "medium answer " * 40]
+    fitted = fit_parts(parts, 300)
+    assert fitted[0] == parts[0] and fitted[2] == parts[2]
+    assert estimate_tokens("\n\n".join(fitted)) <= 300
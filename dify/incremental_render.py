@@ -0,0 +1,104 @@
+import hashlib
+
+from format_jira_ticket import assemble_ticket, atlassian_to_markdown, format_comment, format_issue
+
+# Ticket sections converted from markup, and the issue field each comes from.
+_MARKUP_SECTIONS = (
+    ("root_cause", "customfield_10205"),
+    ("description", "description"),
+)
+
+
+def _digest(text) -> str:
+    return hashlib.blake2b(str(text).encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+def render_incremental(issue: dict, state: dict = None, convert=atlassian_to_markdown) -> tuple:
+    """
+    Render an issue, reusing the sections of a previous render that did not change.
+
+    state is the dict returned by the previous call for the same issue (or
+    None). If the issue's `updated` timestamp is unchanged the cached ticket is
+    returned as is. Otherwise root cause and description are reconverted only
+    when their raw text changed, and a comment only when its `id` is new or its
+    `updated` value moved; everything else is spliced in from the cache.
+
+    Returns (ticket, new_state). new_state is plain JSON so a polling loop can
+    persist it between runs; its "rendered" list names the sections that were
+    converted this time. Null fields are treated as empty, as in
+    format_issue(), whose output the ticket matches.
+    """
+    fields = issue["fields"]
+    updated = fields.get("updated")
+    if state is None or state.get("key") != issue["key"]:
+        state = {}
+    elif updated is not None and state.get("updated") == updated:
+        return state["ticket"], dict(state, rendered=[])
+
+    rendered = []
+    new_state = {"key": issue["key"], "updated": updated}
+    for section, field in _MARKUP_SECTIONS:
+        raw = fields.get(field) or ""
+        digest = _digest(raw)
+        cached = state.get(section)
+        if cached is None or cached["digest"] != digest:
+            cached = {"digest": digest, "markdown": convert(raw)}
+            rendered.append(section)
+        new_state[section] = cached
+
+    previous = {c["id"]: c for c in state.get("comments", []) if c["id"] is not None}
+    comments = []
+    for comment in (fields.get("comment") or {}).get("comments") or []:
+        comment_id = comment.get("id")
+        comment_updated = comment.get("updated")
+        cached = previous.get(comment_id)
+        if cached is None or comment_updated is None or cached["updated"] != comment_updated:
+            cached = {
+                "id": comment_id,
+                "updated": comment_updated,
+                "markdown": format_comment(comment, convert),
+            }
+            rendered.append(f"comment:{comment_id}")
+        comments.append(cached)
+    new_state["comments"] = comments
+
+    new_state["ticket"] = assemble_ticket(
+        issue["key"],
+        fields.get("summary") or "",
+        new_state["root_cause"]["markdown"],
+        new_state["description"]["markdown"],
+        "\n---\n".join(c["markdown"] for c in comments),
+    )
+    new_state["rendered"] = rendered
+    return new_state["ticket"], new_state
+
+
+if __name__ == "__main__":
+    from bench_format_jira import make_issue
+
+    issue = make_issue("ER-1", comments=5, comment_bytes=512, description_bytes=4096, density=0.5)
+    fields = issue["fields"]
+    fields["updated"] = "2025-06-01T10:00:00.000+0000"
+    for comment in fields["comment"]["comments"]:
+        comment["updated"] = fields["updated"]
+    ticket, state = render_incremental(issue)
+    assert ticket == format_issue(issue)
+    assert len(state["rendered"]) == 2 + 5
+
+    # Same timestamp: nothing is converted
+    assert render_incremental(issue, state) == (ticket, dict(state, rendered=[]))
+
+    # One edited and one new comment: only those two are converted again
+    comments = fields["comment"]["comments"]
+    comments[1] = dict(comments[1], body="Edited *again*.", updated="2025-06-02T09:00:00.000+0000")
+    comments.append({"id": "20000", "author": {"displayName": "New"}, "body": "h2. Added",
+                     "updated": "2025-06-02T09:00:00.000+0000"})
+    fields["updated"] = "2025-06-02T09:00:00.000+0000"
+    ticket, state = render_incremental(issue, state)
+    assert ticket == format_issue(issue)
+    assert state["rendered"] == ["comment:10001", "comment:20000"]
+
+    # Null fields render as empty, the same as format_issue()
+    sparse = {"key": "ER-2", "fields": {"summary": None, "description": None,
+                                        "customfield_10205": None, "comment": None}}
+    assert render_incremental(sparse)[0] == format_issue(sparse)
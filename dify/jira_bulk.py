@@ -0,0 +1,222 @@
+import argparse
+import json
+import multiprocessing.util
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from conversion_cache import ConversionCache
+from format_jira_ticket import LogCompactor, atlassian_to_markdown, format_issue, project_issue
+
+_DECODER = json.JSONDecoder()
+
+# Markup converter used by _format_entry(); _init_worker() swaps in a cache
+# and/or a LogCompactor.
+_convert = atlassian_to_markdown
+_cache = None
+
+
+def _init_worker(cache_path: str = None, compact_logs: bool = False) -> None:
+    global _convert, _cache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+    _convert = atlassian_to_markdown
+    if cache_path is not None:
+        _convert = _cache = ConversionCache(path=cache_path)
+        # Pool workers are never told they are done; close the cache as the
+        # process exits so its held-back last_used updates are written
+        multiprocessing.util.Finalize(_cache, _cache.close, exitpriority=10)
+    if compact_logs:
+        _convert = LogCompactor(_convert)
+
+
+def _format_entry(entry: dict) -> dict:
+    """
+    Format one issue, turning any failure into an error record so a single
+    malformed ticket cannot abort the batch.
+    """
+    issue = entry.get("issue", entry) if isinstance(entry, dict) else entry
+    key = issue.get("key") if isinstance(issue, dict) else None
+    try:
+        if isinstance(_convert, LogCompactor):
+            _convert.bytes_saved = 0
+            result = format_issue(issue, _convert)
+            return {"key": key, "result": result, "log_bytes_saved": _convert.bytes_saved}
+        return {"key": key, "result": format_issue(issue, _convert)}
+    except Exception as exc:
+        return {"key": key, "error": f"{type(exc).__name__}: {exc}"}
+
+
+def format_issues_parallel(issues: list, workers: int = None, chunk_size: int = 16,
+                           cache_path: str = None, compact_logs: bool = False) -> list:
+    """
+    Format many Jira issues across a process pool.
+
+    Issues are sent to the workers in chunks of chunk_size and the records
+    come back in input order, each either {"key", "result"} or {"key", "error"}.
+    workers defaults to the CPU count; workers=1 formats in this process.
+    Issues are projected to the formatter's fields first, so only a small
+    fraction of each payload is pickled to the workers. With cache_path, every
+    worker converts through a ConversionCache sharing that SQLite file. With
+    compact_logs, repeated log lines are collapsed before conversion and each
+    record reports its "log_bytes_saved".
+    """
+    issues = [project_issue(entry.get("issue", entry)) if isinstance(entry, dict) else entry
+              for entry in issues]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(issues) <= chunk_size:
+        _init_worker(cache_path, compact_logs)
+        return [_format_entry(entry) for entry in issues]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cache_path, compact_logs)) as pool:
+        return list(pool.map(_format_entry, issues, chunksize=chunk_size))
+
+
+class _JsonStream:
+    """
+    Minimal incremental reader over a JSON text file.
+
+    Only the part of the file that has not been consumed yet is buffered, so
+    decoding one array element at a time keeps memory bounded by the largest
+    element rather than the whole document.
+    """
+
+    def __init__(self, f, chunk_size: int):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size: int) -> None:
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self) -> str:
+        """Skip whitespace and return the next character ('' at end of file)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill(self.chunk_size)
+
+    def take(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} at offset {self.pos} of the buffered input")
+        self.pos += 1
+
+    def decode(self):
+        """Decode the next complete JSON value, reading more input as needed."""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # A value ending exactly at the buffer edge (e.g. a number)
+                # may continue in the next chunk.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            self._fill(size)
+            size *= 2
+
+    def iter_array(self):
+        self.take("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.take("]")
+                return
+
+
+def iter_issues(path: str, chunk_size: int = 1 << 16):
+    """
+    Yield the issues of a Jira export one at a time.
+
+    Accepts a list of issues (or {"issue": ...} entries) or a search result
+    object with an "issues" array; other top-level members are skipped.
+    Peak memory is bounded by the largest single issue.
+    """
+    with open(path, encoding="utf-8") as f:
+        stream = _JsonStream(f, chunk_size)
+        if stream.peek() == "[":
+            yield from stream.iter_array()
+            return
+        stream.take("{")
+        while stream.peek() != "}":
+            key = stream.decode()
+            stream.take(":")
+            if key == "issues":
+                yield from stream.iter_array()
+            else:
+                stream.decode()
+            if stream.peek() == ",":
+                stream.pos += 1
+
+
+def stream_format(path: str, chunk_size: int = 1 << 16, cache_path: str = None,
+                  compact_logs: bool = False):
+    """Yield {"key", "result"} / {"key", "error"} records while reading an export."""
+    _init_worker(cache_path, compact_logs)
+    for entry in iter_issues(path, chunk_size):
+        yield _format_entry(entry)
+
+
+def load_issues(path: str) -> list:
+    """Load issues from a get_issue response list or a JQL search export."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return data.get("issues", [])
+    return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bulk-format a Jira export into Markdown tickets (JSON lines).")
+    parser.add_argument("export",
+                        help="JSON file with a list of issues or a search result with 'issues'")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=16,
+                        help="issues sent to a worker at a time")
+    parser.add_argument("--stream", action="store_true",
+                        help="read the export incrementally and format in this process")
+    parser.add_argument("--cache", default=None,
+                        help="SQLite file caching conversions across runs")
+    parser.add_argument("--compact-logs", action="store_true",
+                        help="collapse repeated log lines and stack frames before conversion")
+    args = parser.parse_args()
+
+    if args.stream:
+        records = stream_format(args.export, cache_path=args.cache,
+                                compact_logs=args.compact_logs)
+    else:
+        records = format_issues_parallel(load_issues(args.export), args.workers,
+                                         args.chunk_size, args.cache, args.compact_logs)
+
+    failures = 0
+    saved = 0
+    for record in records:
+        failures += "error" in record
+        saved += record.get("log_bytes_saved", 0)
+        print(json.dumps(record, ensure_ascii=False))
+    if args.compact_logs:
+        print(f"log compaction saved {saved} bytes", file=sys.stderr)
+    if failures:
+        print(f"{failures} issue(s) failed to format", file=sys.stderr)
@@ -0,0 +1,365 @@
+import argparse
+import asyncio
+import base64
+import collections
+import gzip
+import json
+import os
+import ssl
+import sys
+import time
+import urllib.parse
+
+from format_jira_ticket import (assemble_ticket, atlassian_to_markdown, format_comment, format_issue,
+                                jira_query_params, project_issue)
+
+
+class JiraError(Exception):
+    """A Jira request answered with a non-200 status."""
+
+    def __init__(self, status: int, reason: str, target: str):
+        super().__init__(f"{status} {reason} for {target}")
+        self.status = status
+
+
+class JiraSession:
+    """
+    Pool of keep-alive HTTP/1.1 connections to one Jira site.
+
+    At most `limit` requests are in flight; each takes an idle connection or
+    opens a new one and returns it to the pool afterwards, so a bulk run pays
+    the TCP/TLS handshake once per connection rather than once per issue.
+    auth is (user, api_token) for basic auth or a bearer token string.
+    Built on asyncio streams, so it needs nothing outside the standard library.
+    """
+
+    def __init__(self, base_url: str, auth=None, limit: int = 8, timeout: float = 30.0):
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.prefix = url.path.rstrip("/")
+        self.timeout = timeout
+        headers = {
+            "Host": url.netloc,
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip",
+            "Connection": "keep-alive",
+        }
+        if isinstance(auth, tuple):
+            token = base64.b64encode(":".join(auth).encode("utf-8")).decode("ascii")
+            headers["Authorization"] = f"Basic {token}"
+        elif auth:
+            headers["Authorization"] = f"Bearer {auth}"
+        self._headers = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        self._slots = asyncio.Semaphore(limit)
+        self._idle = []
+        self.requests = 0
+        self.connections = 0
+
+    async def _connect(self):
+        self.connections += 1
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def _roundtrip(self, reader, writer, target: str) -> tuple:
+        writer.write(f"GET {target} HTTP/1.1\r\n{self._headers}\r\n".encode("latin-1"))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        version, status, *reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while await reader.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                parts.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(parts)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        if headers.get("content-encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        return int(status), reason[0] if reason else "", keep_alive, body
+
+    async def get_json(self, path: str, params: dict = None):
+        """GET a path below the base URL and decode the JSON response."""
+        target = self.prefix + path
+        if params:
+            target += "?" + urllib.parse.urlencode(params)
+        async with self._slots:
+            while True:
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._connect()
+                try:
+                    status, reason, keep_alive, body = await asyncio.wait_for(
+                        self._roundtrip(reader, writer, target), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        # The server dropped an idle keep-alive connection; retry
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                break
+            self.requests += 1
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+        if status != 200:
+            raise JiraError(status, reason, target)
+        return json.loads(body)
+
+    async def close(self) -> None:
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def fetch_issue(session: JiraSession, key: str, projection: dict = None) -> dict:
+    """Fetch one issue, asking Jira for (and keeping) only the fields the formatter reads."""
+    issue = await session.get_json(f"/rest/api/2/issue/{urllib.parse.quote(key)}",
+                                   jira_query_params(projection))
+    return project_issue(issue, projection)
+
+
+def has_more_comments(page: dict) -> bool:
+    """True if an embedded comment page stops short of the issue's comment total."""
+    return page.get("startAt", 0) + len(page.get("comments") or ()) < page.get("total", 0)
+
+
+async def iter_comments(session: JiraSession, key: str, page: dict, window: int = 4):
+    """
+    Yield every comment of an issue, starting from the page embedded in it.
+
+    If the embedded page is truncated (see has_more_comments()), the remaining
+    pages are requested from the issue's /comment endpoint with the embedded
+    page's maxResults, up to `window` of them at once, and their comments are
+    yielded in order as each page arrives. At most `window` pages are held at
+    any time. A page the server cut short is topped up before moving on, and
+    comments seen on an earlier page (e.g. after an insert shifted the
+    offsets) are skipped.
+    """
+    comments = page.get("comments") or []
+    start = page.get("startAt", 0) + len(comments)
+    total = page.get("total", start)
+    step = page.get("maxResults") or len(comments) or 50
+    path = f"/rest/api/2/issue/{urllib.parse.quote(key)}/comment"
+    offsets = iter(range(start, total, step))
+    inflight = collections.deque()
+
+    def schedule():
+        while len(inflight) < window:
+            offset = next(offsets, None)
+            if offset is None:
+                return
+            inflight.append((offset, asyncio.ensure_future(
+                session.get_json(path, {"startAt": offset, "maxResults": step}))))
+
+    # Start fetching before handing out the embedded page, so the requests
+    # overlap with formatting it
+    schedule()
+    try:
+        seen = set()
+        for comment in comments:
+            seen.add(comment.get("id"))
+            yield comment
+        while inflight:
+            offset, request = inflight.popleft()
+            data = await request
+            schedule()
+            end = min(offset + step, total)
+            while True:
+                batch = data.get("comments", [])
+                for comment in batch:
+                    comment_id = comment.get("id")
+                    if comment_id is not None:
+                        if comment_id in seen:
+                            continue
+                        seen.add(comment_id)
+                    yield comment
+                offset += len(batch)
+                if not batch or offset >= end:
+                    break
+                data = await session.get_json(path, {"startAt": offset, "maxResults": end - offset})
+    finally:
+        for _, request in inflight:
+            request.cancel()
+        await asyncio.gather(*(request for _, request in inflight), return_exceptions=True)
+
+
+async def format_comments_paged(session: JiraSession, key: str, page: dict,
+                                convert=atlassian_to_markdown) -> str:
+    """
+    format_comments_display() over every comment of an issue, fetching the
+    pages missing from the embedded one. Each comment is formatted as it
+    arrives, so only the formatted text accumulates, not the raw pages.
+    """
+    parts = []
+    async for comment in iter_comments(session, key, page):
+        parts.append(format_comment(comment, convert))
+    return "\n---\n".join(parts)
+
+
+async def format_issue_paged(session: JiraSession, issue: dict, convert=atlassian_to_markdown) -> str:
+    """
+    format_issue() for an issue whose embedded comment page may be truncated.
+    Null fields are treated as empty, as in format_issue().
+    """
+    fields = issue["fields"]
+    page = fields.get("comment") or {}
+    if not has_more_comments(page):
+        return format_issue(issue, convert)
+    root_cause = convert(fields.get("customfield_10205") or "")
+    description = convert(fields.get("description") or "")
+    comments = await format_comments_paged(session, issue["key"], page, convert)
+    return assemble_ticket(issue["key"], fields.get("summary") or "", root_cause, description,
+                           comments)
+
+
+async def iter_formatted(session: JiraSession, keys, concurrency: int = 8,
+                         queue_size: int = 32, convert=atlassian_to_markdown):
+    """
+    Fetch issues concurrently and yield {"key", "result"} / {"key", "error"}
+    records in completion order.
+
+    `concurrency` fetchers pull keys from a shared iterator and put issues on a
+    queue holding at most queue_size entries, so fetching runs ahead of the
+    formatter by a bounded amount however many keys there are. Formatting
+    happens in this generator, between the fetchers' network waits. Issues
+    with more comments than their embedded page get the rest fetched by
+    format_issue_paged().
+    """
+    queue = asyncio.Queue(queue_size)
+    pending = iter(keys)
+    done = object()
+
+    async def fetcher():
+        for key in pending:
+            try:
+                await queue.put((key, await fetch_issue(session, key)))
+            except Exception as exc:
+                await queue.put((key, exc))
+        await queue.put((None, done))
+
+    workers = [asyncio.create_task(fetcher()) for _ in range(concurrency)]
+    try:
+        running = len(workers)
+        while running:
+            key, issue = await queue.get()
+            if issue is done:
+                running -= 1
+                continue
+            if isinstance(issue, Exception):
+                yield {"key": key, "error": f"{type(issue).__name__}: {issue}"}
+                continue
+            try:
+                yield {"key": key, "result": await format_issue_paged(session, issue, convert)}
+            except Exception as exc:
+                yield {"key": key, "error": f"{type(exc).__name__}: {exc}"}
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+def fetch_and_format(keys: list, base_url: str, auth=None, concurrency: int = 8,
+                     queue_size: int = 32, convert=atlassian_to_markdown) -> list:
+    """
+    Fetch and format issues by key over one pooled session; records come back
+    in the order of keys, like format_issues_parallel().
+    """
+    async def run():
+        async with JiraSession(base_url, auth, limit=concurrency) as session:
+            return [record async for record in
+                    iter_formatted(session, keys, concurrency, queue_size, convert)]
+
+    records = {record["key"]: record for record in asyncio.run(run())}
+    return [records[key] for key in keys]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fetch Jira issues concurrently and format them as Markdown (JSON lines).")
+    parser.add_argument("keys", nargs="*", help="issue keys, e.g. ER-14520")
+    parser.add_argument("--base-url", default=os.environ.get("JIRA_BASE_URL"),
+                        help="Jira site (default: $JIRA_BASE_URL)")
+    parser.add_argument("--user", default=os.environ.get("JIRA_USER"),
+                        help="account for basic auth (default: $JIRA_USER)")
+    parser.add_argument("--token", default=os.environ.get("JIRA_API_TOKEN"),
+                        help="API token (default: $JIRA_API_TOKEN); a bearer token without --user")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="requests in flight and pooled connections")
+    parser.add_argument("--queue-size", type=int, default=32,
+                        help="fetched issues allowed to wait for the formatter")
+    parser.add_argument("--mock", type=int, metavar="N",
+                        help="serve N synthetic issues from a local mock Jira, fetch them all "
+                             "and check the output against formatting them directly")
+    parser.add_argument("--mock-comments", type=int, default=20,
+                        help="with --mock, comments per issue")
+    parser.add_argument("--mock-page-size", type=int, default=None,
+                        help="with --mock, embed only this many comments per issue and serve "
+                             "the rest from the paginated comment endpoint")
+    args = parser.parse_args()
+
+    if args.mock:
+        from jira_mock import MockJira
+
+        with MockJira(count=args.mock, comments=args.mock_comments,
+                      page_size=args.mock_page_size) as jira:
+            keys = list(jira.issues)
+            # Jira sends empty fields as null; both paths must read them as empty
+            for key in keys[::3]:
+                jira.issues[key]["fields"].update(summary=None, description=None,
+                                                  customfield_10205=None)
+            started = time.perf_counter()
+            records = fetch_and_format(keys, jira.url, concurrency=args.concurrency,
+                                       queue_size=args.queue_size)
+            elapsed = time.perf_counter() - started
+            for record in records:
+                expected = format_issue(jira.issues[record["key"]])
+                if record.get("result") != expected:
+                    sys.exit(f"{record['key']}: fetched output differs: {record.get('error')}")
+            print(f"{len(keys)} issues in {elapsed:.2f} s "
+                  f"({len(keys) / elapsed:.1f} issues/s, {jira.requests} requests)",
+                  file=sys.stderr)
+        sys.exit(0)
+
+    if not args.base_url or not args.keys:
+        parser.error("issue keys and --base-url (or $JIRA_BASE_URL) are required")
+    auth = (args.user, args.token) if args.user else args.token
+    failures = 0
+    for record in fetch_and_format(args.keys, args.base_url, auth, args.concurrency,
+                                   args.queue_size):
+        failures += "error" in record
+        print(json.dumps(record, ensure_ascii=False))
+    if failures:
+        print(f"{failures} issue(s) failed", file=sys.stderr)
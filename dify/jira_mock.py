@@ -0,0 +1,169 @@
+import argparse
+import json
+import random
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_format_jira import make_issue, make_page
+
+_ISSUE_PATH = "/rest/api/2/issue/"
+_CONTENT_PATH = "/wiki/rest/api/content/"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, Nagle's
+    # algorithm holds the body back on every keep-alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        jira = self.server.jira
+        with jira.lock:
+            jira.requests += 1
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith(_CONTENT_PATH):
+            self._content(urllib.parse.unquote(url.path[len(_CONTENT_PATH):]), url.query)
+            return
+        if not url.path.startswith(_ISSUE_PATH):
+            self._send(404, {"errorMessages": [f"no route for {url.path}"]})
+            return
+        key, _, resource = urllib.parse.unquote(url.path[len(_ISSUE_PATH):]).partition("/")
+        issue = jira.issues.get(key)
+        if issue is None or resource not in ("", "comment"):
+            self._send(404, {"errorMessages": ["Issue does not exist or you do not have "
+                                               "permission to see it."]})
+            return
+        comments = issue["fields"]["comment"]["comments"]
+        if resource == "comment":
+            query = urllib.parse.parse_qs(url.query)
+            start = int(query.get("startAt", ["0"])[0])
+            limit = min(int(query.get("maxResults", ["50"])[0]), jira.page_size or len(comments))
+            self._send(200, {"comments": comments[start:start + limit], "startAt": start,
+                             "maxResults": limit, "total": len(comments)})
+        elif jira.page_size is not None and len(comments) > jira.page_size:
+            # Embed only the first page, as Jira does for long comment threads
+            fields = dict(issue["fields"], comment={
+                "comments": comments[:jira.page_size], "startAt": 0,
+                "maxResults": jira.page_size, "total": len(comments)})
+            self._send(200, dict(issue, fields=fields))
+        else:
+            self._send(200, issue)
+
+    def _content(self, page_id: str, query: str) -> None:
+        page = self.server.jira.pages.get(page_id)
+        if page is None:
+            self._send(404, {"statusCode": 404, "message": f"No content found with id: {page_id}"})
+            return
+        expand = ",".join(urllib.parse.parse_qs(query).get("expand", [""]))
+        if "body.storage" not in expand:
+            # Like Confluence, the body is only sent when asked for
+            page = {name: value for name, value in page.items() if name != "body"}
+        self._send(200, page)
+
+
+class _Server(ThreadingHTTPServer):
+    # socketserver listens with a backlog of 5; a client opening a pool of
+    # connections at once would have SYNs dropped and retried a second later
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class MockJira:
+    """
+    Local stand-in for the Jira REST API v2, serving issues in the get_issue
+    payload shape from a background thread.
+
+    issues maps issue keys to payloads; by default `count` synthetic issues
+    from bench_format_jira.make_issue() are served as MOCK-1, MOCK-2, ...
+    With page_size, issues embed only their first page_size comments and the
+    rest are served by the paginated /comment endpoint, which never returns
+    more than page_size per request either. pages maps Confluence page ids
+    to get_page payloads served at /wiki/rest/api/content/{id}; by default
+    `page_count` synthetic pages with ids 1, 2, ... The server speaks
+    HTTP/1.1 keep-alive and counts the requests it answers.
+    """
+
+    def __init__(self, issues: dict = None, count: int = 10, comments: int = 20,
+                 comment_bytes: int = 512, description_bytes: int = 4096,
+                 page_size: int = None, pages: dict = None, page_count: int = 0,
+                 page_bytes: int = 64 * 1024):
+        if issues is None:
+            issues = {}
+            for i in range(1, count + 1):
+                key = f"MOCK-{i}"
+                issues[key] = make_issue(key, comments, comment_bytes, description_bytes,
+                                         0.2, seed=i)
+        self.issues = issues
+        if pages is None:
+            pages = {}
+            for i in range(1, page_count + 1):
+                pages[str(i)] = {
+                    "id": str(i), "type": "page", "title": f"Mock page {i}",
+                    "version": {"number": 1},
+                    "body": {"storage": {"value": make_page(random.Random(i), page_bytes),
+                                         "representation": "storage"}},
+                }
+        self.pages = pages
+        self.page_size = page_size
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "MockJira":
+        self.server = _Server((host, port), _Handler)
+        self.server.jira = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic Jira issues on localhost.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--count", type=int, default=10, help="issues to serve (MOCK-1..N)")
+    parser.add_argument("--comments", type=int, default=20, help="comments per issue")
+    parser.add_argument("--page-size", type=int, default=None,
+                        help="comments embedded in an issue and returned per /comment page")
+    parser.add_argument("--pages", type=int, default=0,
+                        help="Confluence pages to serve (ids 1..N)")
+    args = parser.parse_args()
+
+    jira = MockJira(count=args.count, comments=args.comments, page_size=args.page_size,
+                    page_count=args.pages).start(port=args.port)
+    print(f"serving {args.count} issues at {jira.url}{_ISSUE_PATH}MOCK-1")
+    if args.pages:
+        print(f"serving {args.pages} pages at {jira.url}{_CONTENT_PATH}1")
+    try:
+        jira.thread.join()
+    except KeyboardInterrupt:
+        jira.stop()
